@@ -27,6 +27,12 @@ parser.add_argument('--demo', default=False, action='store_true',
                     help='Inference demo.')
 parser.add_argument('--energy_ft', default=False, action='store_true',
                     help='Mode for fine-tuning ood.')
+parser.add_argument('--cuda_graph', default=False, action='store_true',
+                    help='Capture the training forward and backward passes in CUDA graphs.')
+parser.add_argument('--compile', default=False, action='store_true',
+                    help='Compile the feature network with torch.compile.')
+parser.add_argument('--amp', default=False, action='store_true',
+                    help='Run forward passes in bfloat16 autocast.')
 args = parser.parse_args()
 
 #############################
@@ -45,7 +51,7 @@ os.environ["NUMEXPR_NUM_THREADS"] = str(args.np_threads)
 # Load configurations to args #
 ###############################
 with open(args.config) as f:
-    config = yaml.load(f, Loader=yaml.FullLoader)
+    config = yaml.load(f, Loader=getattr(yaml, 'CFullLoader', yaml.FullLoader))
 for k, v in config.items():
     setattr(args, k, v)
 
@@ -1,6 +1,5 @@
 import os
 import numpy as np
-import copy
 from datetime import datetime
 from tqdm import tqdm
 from shutil import copyfile
@@ -62,6 +61,7 @@ class DEMO(OLTR):
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path,
                              num_layers=self.args.num_layers, init_feat_only=False)
+        self.compile_net()
 
     def demo_inference(self, loader):
         eval_info, preds_conf, preds_unconf = self.deploy_epoch(loader)
@@ -91,14 +91,13 @@ class DEMO(OLTR):
         total_max_probs = []
         total_energy = []
         total_probs = []
-        total_feats = []
 
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
             for data, file_id, labels in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data = data.cuda()
-                labels = labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
@@ -111,21 +110,20 @@ class DEMO(OLTR):
 
                 energy_score = -(self.args.energy_T * torch.logsumexp(logits / self.args.energy_T, dim=1))
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_max_probs.append(max_probs.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_max_probs.append(max_probs)
                 total_file_id.append(file_id)
-                total_energy.append(energy_score.detach().cpu().numpy())
-                total_probs.append(probs.detach().cpu().numpy())
-                total_feats.append(meta_feats.detach().cpu().numpy())
+                total_energy.append(energy_score)
+                total_probs.append(probs)
 
+        # Results stay on device during the loop and are copied to host once
         total_file_id = np.concatenate(total_file_id, axis=0)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
-        total_max_probs = np.concatenate(total_max_probs, axis=0)
-        total_energy = np.concatenate(total_energy, axis=0)
-        total_probs = np.concatenate(total_probs, axis=0)
-        total_feats = np.concatenate(total_feats, axis=0)
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_max_probs = torch.cat(total_max_probs).cpu().numpy()
+        total_energy = torch.cat(total_energy).cpu().numpy()
+        total_probs = torch.cat(total_probs).cpu().numpy()
 
         eval_info = '{} Picking confident samples... \n'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
 
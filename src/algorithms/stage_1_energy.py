@@ -37,12 +37,14 @@ class EnergyStage1(PlainStage1):
                                                batch_size=self.args.batch_size * 2,
                                                shuffle=True,
                                                num_workers=self.args.num_workers,
+                                               persistent_workers=True,
                                                cas_sampler=False)
         # setup network
         self.logger.info('\nGetting {} model.'.format(self.args.model_name))
         self.logger.info('\nLoading from {}'.format(self.weights_path))
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path, num_layers=self.args.num_layers, init_feat_only=False)
+        self.compile_net()
         self.set_optimizers()
 
     def set_eval(self):
@@ -54,6 +56,7 @@ class EnergyStage1(PlainStage1):
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path.replace('.pth', '_ft.pth'), num_layers=self.args.num_layers,
                              init_feat_only=False)
+        self.compile_net()
 
     def set_optimizers(self):
         ######################
@@ -108,15 +111,15 @@ class EnergyStage1(PlainStage1):
         self.logger.info(eval_info)
         conf_preds_path = self.weights_path.replace('.pth', '_conf_preds.npy')
         self.logger.info('Saving confident predictions to {}'.format(conf_preds_path))
-        conf_preds.tofile(conf_preds_path)
+        np.save(conf_preds_path, conf_preds)
 
         init_pseudo_hard_path = self.weights_path.replace('.pth', '_init_pseudo_hard.npy')
         self.logger.info('Saving initial hard pseudo labels to {}'.format(init_pseudo_hard_path))
-        init_pseudo_hard.tofile(init_pseudo_hard_path)
+        np.save(init_pseudo_hard_path, init_pseudo_hard)
 
         init_pseudo_soft_path = self.weights_path.replace('.pth', '_init_pseudo_soft.npy')
         self.logger.info('Saving initial soft pseudo targets to {}'.format(init_pseudo_soft_path))
-        init_pseudo_soft.tofile(init_pseudo_soft_path)
+        np.save(init_pseudo_soft_path, init_pseudo_soft)
 
         return f1
 
@@ -140,16 +143,11 @@ class EnergyStage1(PlainStage1):
                 out_iter = iter(self.trainloaderunknown)
                 data_out, _ = next(out_iter)
 
-            data = torch.cat((data_in, data_out), dim=0)
-
-            # log basic adda train info
-            info_str = '[Energy FTing {} - Stage 1] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
-                                                                                      N, 100 * batch_idx / N)
-
             ########################
             # Setup data variables #
             ########################
-            data, labels = data.cuda(), labels.cuda()
+            data = self.stage_input(data_in, data_out)
+            labels = labels.cuda(non_blocking=True)
 
             data.requires_grad = False
             labels.requires_grad = False
@@ -158,8 +156,10 @@ class EnergyStage1(PlainStage1):
             # Forward and loss #
             ####################
             # forward
-            feats = self.net.feature(data)
-            logits = self.net.classifier(feats)
+            with self.autocast():
+                feats = self.net.feature(data)
+                logits = self.net.classifier(feats)
+            logits = logits.float()
 
             # calculate xent loss
             xent = self.net.criterion_cls(logits[:len(data_in)], labels)
@@ -178,7 +178,7 @@ class EnergyStage1(PlainStage1):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_net.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
@@ -189,6 +189,9 @@ class EnergyStage1(PlainStage1):
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[Energy FTing {} - Stage 1] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
+                                                                                          N, 100 * batch_idx / N)
                 # compute overall acc
                 preds = logits[:len(data_in)].argmax(dim=1)
                 acc = (preds == labels).float().mean()
@@ -201,9 +204,6 @@ class EnergyStage1(PlainStage1):
         # Get unique classes in the loader and corresponding counts
         loader_uni_class, eval_class_counts = loader.dataset.class_counts_cal()
         total_preds, total_labels, total_logits = self.evaluate_forward(loader, ood=True)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
-        total_logits = np.concatenate(total_logits, axis=0)
         eval_info, f1, conf_preds = self.evaluate_metric(total_preds, total_labels,
                                                          eval_class_counts, ood=True)
         return eval_info, f1, conf_preds, total_preds, total_logits
@@ -214,18 +214,21 @@ class EnergyStage1(PlainStage1):
         total_logits = []
 
         # Forward and record # correct predictions of each class
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for data, labels in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
                 # forward
-                feats = self.net.feature(data)
-                logits = self.net.classifier(feats)
+                with self.autocast():
+                    feats = self.net.feature(data)
+                    logits = self.net.classifier(feats)
+                logits = logits.float()
 
                 max_probs, preds = F.softmax(logits, dim=1).max(dim=1)
 
@@ -234,8 +237,13 @@ class EnergyStage1(PlainStage1):
                     # Set unconfident prediction to -1
                     preds[-energy_score <= self.args.energy_the] = -1
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_logits.append(logits.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_logits.append(logits)
+
+        # Results stay on device during the loop and are copied to host once
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_logits = torch.cat(total_logits).cpu().numpy()
 
         return total_preds, total_labels, total_logits
@@ -31,6 +31,7 @@ def load_data(args):
                                batch_size=args.batch_size,
                                shuffle=True,
                                num_workers=args.num_workers,
+                               persistent_workers=True,
                                cas_sampler=False)
 
     valloader = load_dataset(name=args.dataset_name,
@@ -41,6 +42,7 @@ def load_data(args):
                              batch_size=args.batch_size,
                              shuffle=False,
                              num_workers=args.num_workers,
+                             persistent_workers=True,
                              cas_sampler=False)
 
     valloaderunknown = load_dataset(name=args.unknown_dataset_name,
@@ -104,6 +106,11 @@ class PlainStage1(Algorithm):
 
         self.set_optimizers()
 
+        if self.args.cuda_graph:
+            self.graph_net()
+        else:
+            self.compile_net()
+
     def set_eval(self):
         ###############################
         # Load weights for evaluation #
@@ -112,6 +119,7 @@ class PlainStage1(Algorithm):
         self.logger.info('\nLoading from {}'.format(self.weights_path))
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path, num_layers=self.args.num_layers, init_feat_only=False)
+        self.compile_net()
 
     def set_optimizers(self):
         self.logger.info('** SETTING OPTIMIZERS!!! **')
@@ -133,6 +141,26 @@ class PlainStage1(Algorithm):
         self.opt_net = optim.SGD(net_optim_params_list)
         self.scheduler = optim.lr_scheduler.StepLR(self.opt_net, step_size=self.args.step_size, gamma=self.args.gamma)
 
+    def graph_net(self):
+        # Only the forward and backward passes of feature and classifier are graphed;
+        # the loss and the optimizer step still run eagerly
+        self.logger.info('** CAPTURING CUDA GRAPHS!!! **')
+        # Static input shapes are taken from the first training batch
+        data, _ = next(iter(self.trainloader))
+        data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        feats = torch.randn(len(data), self.net.feature_dim, device=data.device, requires_grad=True)
+        # Warmup iterations update batchnorm statistics, restore them afterwards
+        bn_buffers = [(b, b.clone()) for b in self.net.buffers()]
+        # Capture under the same autocast state used in training
+        with self.autocast():
+            self.net.feature, self.net.classifier = torch.cuda.make_graphed_callables((self.net.feature,
+                                                                                       self.net.classifier),
+                                                                                      ((data,), (feats,)))
+        with torch.no_grad():
+            for b, b_init in bn_buffers:
+                b.copy_(b_init)
+        self.graph_batch_size = len(data)
+
     def train(self):
 
         best_epoch = 0
@@ -170,7 +198,7 @@ class PlainStage1(Algorithm):
         self.logger.info(eval_info)
         conf_preds_path = self.weights_path.replace('.pth', '_conf_preds.npy')
         self.logger.info('Saving confident predictions to {}'.format(conf_preds_path))
-        conf_preds.tofile(conf_preds_path)
+        np.save(conf_preds_path, conf_preds)
         return f1
 
     def train_epoch(self, epoch):
@@ -181,14 +209,15 @@ class PlainStage1(Algorithm):
 
         for batch_idx, (data, labels) in enumerate(self.trainloader):
 
-            # log basic adda train info
-            info_str = '[Training {} - Stage 1] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
-                                                                                     N, 100 * batch_idx / N)
+            # Graphed modules only accept the captured batch size
+            if self.args.cuda_graph and len(data) != self.graph_batch_size:
+                continue
 
             ########################
             # Setup data variables #
             ########################
-            data, labels = data.cuda(), labels.cuda()
+            data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            labels = labels.cuda(non_blocking=True)
             data.requires_grad = False
             labels.requires_grad = False
 
@@ -196,8 +225,10 @@ class PlainStage1(Algorithm):
             # Forward and loss #
             ####################
             # forward
-            feats = self.net.feature(data)
-            logits = self.net.classifier(feats)
+            with self.autocast():
+                feats = self.net.feature(data)
+                logits = self.net.classifier(feats)
+            logits = logits.float()
             # calculate loss
             loss = self.net.criterion_cls(logits, labels)
 
@@ -205,7 +236,7 @@ class PlainStage1(Algorithm):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_net.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
@@ -215,6 +246,9 @@ class PlainStage1(Algorithm):
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[Training {} - Stage 1] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
+                                                                                         N, 100 * batch_idx / N)
                 # compute overall acc
                 preds = logits.argmax(dim=1)
                 acc = (preds == labels).float().mean()
@@ -229,8 +263,6 @@ class PlainStage1(Algorithm):
         # Get unique classes in the loader and corresponding counts
         loader_uni_class, eval_class_counts = loader.dataset.class_counts_cal()
         total_preds, total_labels, _ = self.evaluate_forward(loader, ood=False)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
         eval_info, mac_acc, mic_acc = self.evaluate_metric(total_preds, total_labels, 
                                                            eval_class_counts, ood=False)
         return eval_info, mac_acc, mic_acc
@@ -243,13 +275,9 @@ class PlainStage1(Algorithm):
 
         self.logger.info("Forward through in test loader\n")
         total_preds_in, total_labels_in, _ = self.evaluate_forward(loader_in, ood=True)
-        total_preds_in = np.concatenate(total_preds_in, axis=0)
-        total_labels_in = np.concatenate(total_labels_in, axis=0)
 
         self.logger.info("Forward through out test loader\n")
         total_preds_out, total_labels_out, _ = self.evaluate_forward(loader_out, ood=True)
-        total_preds_out = np.concatenate(total_preds_out, axis=0)
-        total_labels_out = np.concatenate(total_labels_out, axis=0)
 
         total_preds = np.concatenate((total_preds_out, total_preds_in), axis=0)
         total_labels = np.concatenate((total_labels_out, total_labels_in), axis=0)
@@ -266,8 +294,6 @@ class PlainStage1(Algorithm):
         # Get unique classes in the loader and corresponding counts
         loader_uni_class, eval_class_counts = loader.dataset.class_counts_cal()
         total_preds, total_labels, _ = self.evaluate_forward(loader, ood=True)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
         eval_info, f1, conf_preds = self.evaluate_metric(total_preds, total_labels, 
                                                          eval_class_counts, ood=True)
         return eval_info, f1, conf_preds
@@ -278,18 +304,21 @@ class PlainStage1(Algorithm):
         total_logits = []
 
         # Forward and record # correct predictions of each class
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for data, labels in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
                 # forward
-                feats = self.net.feature(data)
-                logits = self.net.classifier(feats)
+                with self.autocast():
+                    feats = self.net.feature(data)
+                    logits = self.net.classifier(feats)
+                logits = logits.float()
 
                 max_probs, preds = F.softmax(logits, dim=1).max(dim=1)
 
@@ -297,9 +326,14 @@ class PlainStage1(Algorithm):
                 if ood:
                     preds[max_probs < self.args.theta] = -1
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_logits.append(logits.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_logits.append(logits)
+
+        # Results stay on device during the loop and are copied to host once
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_logits = torch.cat(total_logits).cpu().numpy()
 
         return total_preds, total_labels, total_logits
 
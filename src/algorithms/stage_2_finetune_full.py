@@ -37,14 +37,15 @@ class FullFineTuneStage2(PlainStage1):
 
         for batch_idx, (data, labels) in enumerate(self.trainloader):
 
-            # log basic adda train info
-            info_str = '[FineTuning FULL {} - Stage 2] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
-                                                                                            N, 100 * batch_idx / N)
+            # Graphed modules only accept the captured batch size
+            if self.args.cuda_graph and len(data) != self.graph_batch_size:
+                continue
 
             ########################
             # Setup data variables #
             ########################
-            data, labels = data.cuda(), labels.cuda()
+            data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            labels = labels.cuda(non_blocking=True)
             data.requires_grad = False
             labels.requires_grad = False
 
@@ -52,8 +53,10 @@ class FullFineTuneStage2(PlainStage1):
             # Forward and loss #
             ####################
             # forward
-            feats = self.net.feature(data)
-            logits = self.net.classifier(feats)
+            with self.autocast():
+                feats = self.net.feature(data)
+                logits = self.net.classifier(feats)
+            logits = logits.float()
             # calculate loss
             loss = self.net.criterion_cls(logits, labels)
 
@@ -61,7 +64,7 @@ class FullFineTuneStage2(PlainStage1):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_net.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
@@ -71,6 +74,9 @@ class FullFineTuneStage2(PlainStage1):
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[FineTuning FULL {} - Stage 2] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
+                                                                                                N, 100 * batch_idx / N)
                 # compute overall acc
                 preds = logits.argmax(dim=1)
                 acc = (preds == labels).float().mean()
@@ -32,6 +32,7 @@ def load_data(args, conf_preds):
                                batch_size=args.batch_size,
                                shuffle=True,
                                num_workers=args.num_workers,
+                               persistent_workers=True,
                                cas_sampler=False,
                                conf_preds=conf_preds,
                                pseudo_labels_hard=None,
@@ -46,6 +47,7 @@ def load_data(args, conf_preds):
                              batch_size=args.batch_size,
                              shuffle=False,
                              num_workers=args.num_workers,
+                             persistent_workers=True,
                              cas_sampler=False)
 
     valloaderunknown = load_dataset(name=args.unknown_dataset_name,
@@ -94,7 +96,7 @@ class GTFineTuneStage2(PlainStage1):
         #######################################
         # Setup data for training and testing #
         #######################################
-        self.conf_preds = list(np.fromfile(args.weights_init.replace('_ft.pth', '_conf_preds.npy')).astype(int))
+        self.conf_preds = list(np.load(args.weights_init.replace('_ft.pth', '_conf_preds.npy'), mmap_mode='r').astype(int))
         self.trainloader, self.valloader,\
         self.valloaderunknown, self.deployloader = load_data(args, self.conf_preds)
         _, self.train_class_counts = self.trainloader.dataset.class_counts_cal()
@@ -108,14 +110,15 @@ class GTFineTuneStage2(PlainStage1):
 
         for batch_idx, (data, labels) in enumerate(self.trainloader):
 
-            # log basic adda train info
-            info_str = '[LDAM FT GT {} - Stage 2] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
-                                                                                       N, 100 * batch_idx / N)
+            # Graphed modules only accept the captured batch size
+            if self.args.cuda_graph and len(data) != self.graph_batch_size:
+                continue
 
             ########################
             # Setup data variables #
             ########################
-            data, labels = data.cuda(), labels.cuda()
+            data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+            labels = labels.cuda(non_blocking=True)
             data.requires_grad = False
             labels.requires_grad = False
 
@@ -123,8 +126,10 @@ class GTFineTuneStage2(PlainStage1):
             # Forward and loss #
             ####################
             # forward
-            feats = self.net.feature(data)
-            logits = self.net.classifier(feats)
+            with self.autocast():
+                feats = self.net.feature(data)
+                logits = self.net.classifier(feats)
+            logits = logits.float()
             # calculate loss
             loss = self.net.criterion_cls(logits, labels)
 
@@ -132,7 +137,7 @@ class GTFineTuneStage2(PlainStage1):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_net.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
@@ -142,6 +147,9 @@ class GTFineTuneStage2(PlainStage1):
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[LDAM FT GT {} - Stage 2] Epoch: {} [{}/{} ({:.2f}%)] '.format(self.net.name, epoch, batch_idx,
+                                                                                           N, 100 * batch_idx / N)
                 # compute overall acc
                 preds = logits.argmax(dim=1)
                 acc = (preds == labels).float().mean()
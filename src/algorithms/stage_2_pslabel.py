@@ -3,7 +3,6 @@ from os import sep
 import numpy as np
 from datetime import datetime
 from tqdm import tqdm
-import copy
 
 import torch
 import torch.optim as optim
@@ -44,6 +43,7 @@ def load_val_data(args, conf_preds):
                              batch_size=args.batch_size,
                              shuffle=False,
                              num_workers=args.num_workers,
+                             persistent_workers=True,
                              cas_sampler=False)
 
     valloaderunknown = load_dataset(name=args.unknown_dataset_name,
@@ -83,6 +83,7 @@ def load_train_data(args, conf_preds, pseudo_labels_hard, pseudo_labels_soft, ca
                                   batch_size=int(args.batch_size / 3),
                                   shuffle=True,
                                   num_workers=args.num_workers,
+                                  persistent_workers=True,
                                   cas_sampler=cas,
                                   conf_preds=conf_preds,
                                   pseudo_labels_hard=pseudo_labels_hard,
@@ -98,6 +99,7 @@ def load_train_data(args, conf_preds, pseudo_labels_hard, pseudo_labels_soft, ca
                                   batch_size=int(args.batch_size * 2 / 3),
                                   shuffle=True,
                                   num_workers=args.num_workers,
+                                  persistent_workers=True,
                                   cas_sampler=cas,
                                   conf_preds=conf_preds,
                                   pseudo_labels_hard=pseudo_labels_hard,
@@ -132,15 +134,13 @@ class SemiStage2(PlainStage1):
         #######################################
         # Setup data for training and testing #
         #######################################
-        # self.conf_preds = list(np.fromfile(args.weights_init.replace('_ft.pth', '_conf_preds.npy')).astype(int))
-        self.conf_preds = list(np.fromfile('./weights/EnergyStage1/101920_MOZ_S1_0_conf_preds.npy').astype(int))
+        # self.conf_preds = list(np.load(args.weights_init.replace('_ft.pth', '_conf_preds.npy'), mmap_mode='r').astype(int))
+        self.conf_preds = list(np.load('./weights/EnergyStage1/101920_MOZ_S1_0_conf_preds.npy', mmap_mode='r').astype(int))
         (self.trainloader_eval, self.valloader, 
          self.valloaderunknown, self.deployloader) = load_val_data(args, self.conf_preds)
 
-        self.pseudo_labels_hard = np.fromfile('./weights/EnergyStage1/101920_MOZ_S1_0_init_pseudo_hard.npy',
-                                              dtype=np.int)
-        # self.pseudo_labels_hard = np.fromfile(args.weights_init.replace('_ft.pth', '_init_pseudo_hard.npy'),
-        #                                       dtype=np.int)
+        self.pseudo_labels_hard = np.load('./weights/EnergyStage1/101920_MOZ_S1_0_init_pseudo_hard.npy')
+        # self.pseudo_labels_hard = np.load(args.weights_init.replace('_ft.pth', '_init_pseudo_hard.npy'))
         self.pseudo_labels_soft = None
 
         self.train_class_counts = self.trainloader_eval.dataset.class_counts
@@ -160,6 +160,7 @@ class SemiStage2(PlainStage1):
                              weights_init=self.args.weights_init,
                              num_layers=self.args.num_layers, init_feat_only=False,
                              T=self.args.T, alpha=self.args.alpha)
+        self.compile_net()
 
         self.set_optimizers(lr_factor=1.)
 
@@ -195,9 +196,6 @@ class SemiStage2(PlainStage1):
     def pseudo_label_reset(self, loader, soft_reset=False, hard_reset=False):
         self.net.eval()
         total_preds, total_labels, total_logits, conf_preds = self.evaluate_forward(loader, ood=False, out_conf=True)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
-        total_logits = np.concatenate(total_logits, axis=0)
         if soft_reset:
             self.logger.info("** Reseting soft pseudo labels **\n")
             if self.pseudo_labels_soft is not None:
@@ -212,7 +210,7 @@ class SemiStage2(PlainStage1):
                 self.pseudo_labels_hard = total_preds
             pseudo_hard_path = self.weights_path.replace('.pth', '_pseudo_hard.npy')
             self.logger.info('Saving updated hard pseudo labels to {}'.format(pseudo_hard_path))
-            self.pseudo_labels_hard.tofile(pseudo_hard_path)
+            np.save(pseudo_hard_path, self.pseudo_labels_hard)
 
     def train(self):
 
@@ -258,17 +256,11 @@ class SemiStage2(PlainStage1):
         iter_ps = iter(loader_ps)
 
         # N = max(int(len(self.trainloader_eval) * 1.5), len(iter_ps))
-        N = len(iter_ps)
+        N = len(loader_ps)
         
 
         for batch_idx in range(N):
 
-            # log basic adda train info
-            info_str = '[Train Semi (Stage 2)] '
-            info_str += '[Soft] ' if soft else '[Hard] '
-            info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
-                                                              N, 100 * batch_idx / N)
-
             ########################
             # Setup data variables #
             ########################
@@ -283,15 +275,17 @@ class SemiStage2(PlainStage1):
             if soft:
                 data_gt, labels_gt, soft_target_gt = input_gt 
                 data_ps, labels_ps, soft_target_ps = input_ps
-                soft_target = torch.cat((soft_target_gt, soft_target_ps), dim=0).cuda()
+                soft_target = torch.cat((soft_target_gt.cuda(non_blocking=True),
+                                         soft_target_ps.cuda(non_blocking=True)), dim=0)
                 soft_target.requires_grad = False
             else:
                 data_gt, labels_gt = input_gt 
                 data_ps, labels_ps = input_ps
                 soft_target = None
 
-            data = torch.cat((data_gt, data_ps), dim=0).cuda()
-            labels = torch.cat((labels_gt, labels_ps), dim=0).cuda()
+            data = self.stage_input(data_gt, data_ps)
+            labels = torch.cat((labels_gt.cuda(non_blocking=True),
+                                labels_ps.cuda(non_blocking=True)), dim=0)
             data.requires_grad = False
             labels.requires_grad = False
 
@@ -299,8 +293,10 @@ class SemiStage2(PlainStage1):
             # Forward and loss #
             ####################
             # forward
-            feats = self.net.feature(data)
-            logits = self.net.classifier(feats)
+            with self.autocast():
+                feats = self.net.feature(data)
+                logits = self.net.classifier(feats)
+            logits = logits.float()
             # calculate loss
             if soft:
                 loss = self.net.criterion_cls_soft(logits, labels, soft_target)
@@ -311,7 +307,7 @@ class SemiStage2(PlainStage1):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_net.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
@@ -321,6 +317,11 @@ class SemiStage2(PlainStage1):
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[Train Semi (Stage 2)] '
+                info_str += '[Soft] ' if soft else '[Hard] '
+                info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
+                                                                  N, 100 * batch_idx / N)
                 # compute overall acc
                 preds = logits.argmax(dim=1)
                 acc = (preds == labels).float().mean()
@@ -337,18 +338,21 @@ class SemiStage2(PlainStage1):
         total_probs = []
 
         # Forward and record # correct predictions of each class
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for data, labels in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
                 # forward
-                feats = self.net.feature(data)
-                logits = self.net.classifier(feats)
+                with self.autocast():
+                    feats = self.net.feature(data)
+                    logits = self.net.classifier(feats)
+                logits = logits.float()
 
                 max_probs, preds = F.softmax(logits, dim=1).max(dim=1)
 
@@ -356,13 +360,18 @@ class SemiStage2(PlainStage1):
                     # Set unconfident prediction to -1
                     preds[max_probs < self.args.theta] = -1
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_logits.append(logits.detach().cpu().numpy())
-                total_probs.append(max_probs.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_logits.append(logits)
+                total_probs.append(max_probs)
+
+        # Results stay on device during the loop and are copied to host once
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_logits = torch.cat(total_logits).cpu().numpy()
 
         if out_conf:
-            total_probs = np.concatenate(total_probs, axis=0)
+            total_probs = torch.cat(total_probs).cpu().numpy()
             conf_preds = np.zeros(len(total_probs))
             conf_preds[total_probs >= self.args.theta] = 1
             return total_preds, total_labels, total_logits, conf_preds
@@ -1,6 +1,5 @@
 import os
 import numpy as np
-import copy
 from datetime import datetime
 from tqdm import tqdm
 
@@ -10,11 +9,22 @@ import torch.nn.functional as F
 
 from .utils import register_algorithm, Algorithm, acc, WarmupScheduler, ood_metric
 # from .plain_memory_stage_2_conf_pseu import PlainMemoryStage2_ConfPseu
-from src.data.utils import load_dataset
+from src.data.utils import load_dataset, get_dataset, get_loader
 from src.data.class_indices import class_indices
 from src.models.utils import get_model
 
 
+@torch.jit.script
+def meta_embedding(feats, values_nn, concept_selector, memory_feature, reachability_scale: float):
+
+    """
+    Reachability scaled meta embedding, scripted so the elementwise ops fuse into fewer kernels.
+    """
+
+    reachability = (reachability_scale / values_nn).unsqueeze(1)
+    return reachability * (feats + concept_selector.tanh() * memory_feature)
+
+
 def load_data(args, conf_preds, pseudo_labels):
 
     """
@@ -47,6 +57,7 @@ def load_data(args, conf_preds, pseudo_labels):
                              batch_size=args.batch_size,
                              shuffle=False,
                              num_workers=args.num_workers,
+                             persistent_workers=True,
                              cas_sampler=False)
 
     valloaderunknown = load_dataset(name=args.unknown_dataset_name,
@@ -94,9 +105,8 @@ class OLTR(Algorithm):
         # Training epochs and logging intervals
         self.log_interval = args.log_interval
 
-        self.conf_preds = list(np.fromfile('./weights/EnergyStage1/101920_MOZ_S1_1_conf_preds.npy').astype(int))
-        self.pseudo_labels_hard = np.fromfile('./weights/EnergyStage1/101920_MOZ_S1_1_init_pseudo_hard.npy',
-                                              dtype=np.int)
+        self.conf_preds = list(np.load('./weights/EnergyStage1/101920_MOZ_S1_1_conf_preds.npy', mmap_mode='r').astype(int))
+        self.pseudo_labels_hard = np.load('./weights/EnergyStage1/101920_MOZ_S1_1_init_pseudo_hard.npy')
 
         self.pseudo_labels_soft = None
 
@@ -132,6 +142,7 @@ class OLTR(Algorithm):
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.args.weights_init, num_layers=self.args.num_layers,
                              init_feat_only=True, T=self.args.T, alpha=self.args.alpha)
+        self.compile_net()
 
         _ = self.evaluate(self.valloader, hall=True)
 
@@ -145,47 +156,40 @@ class OLTR(Algorithm):
         self.logger.info('\nLoading from {}'.format(self.weights_path))
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path, num_layers=self.args.num_layers, init_feat_only=False)
+        self.compile_net()
 
     def set_optimizers(self):
         self.logger.info('** SETTING OPTIMIZERS!!! **')
         ######################
         # Optimization setup #
         ######################
+        # Setup optimizer parameters for each network component
+        net_optim_params_list = [
+            {'params': self.net.feature.parameters(),
+             'lr': self.args.lr_feature,
+             'momentum': self.args.momentum_feature,
+             'weight_decay': self.args.weight_decay_feature},
+            {'params': self.net.fc_hallucinator.parameters(),
+             'lr': self.args.lr_classifier * 0.1,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.fc_selector.parameters(),
+             'lr': self.args.lr_classifier,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.cosnorm_classifier.parameters(),
+             'lr': self.args.lr_classifier,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.criterion_ctr.parameters(),
+             'lr': self.args.lr_memory,
+             'momentum': self.args.momentum_memory,
+             'weight_decay': self.args.weight_decay_memory}
+        ]
         # Setup optimizer and optimizer scheduler
-        self.opt_feats = optim.SGD([{'params': self.net.feature.parameters(),
-                                     'lr': self.args.lr_feature,
-                                     'momentum': self.args.momentum_feature,
-                                     'weight_decay': self.args.weight_decay_feature}])
-        self.sch_feats = optim.lr_scheduler.StepLR(self.opt_feats, step_size=self.args.step_size,
-                                                   gamma=self.args.gamma)
-
-        self.opt_fc_hall = optim.SGD([{'params': self.net.fc_hallucinator.parameters(),
-                                       'lr': self.args.lr_classifier * 0.1,
-                                       'momentum': self.args.momentum_classifier,
-                                       'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_fc_hall = optim.lr_scheduler.StepLR(self.opt_fc_hall, step_size=self.args.step_size,
-                                                     gamma=self.args.gamma)
-
-        self.opt_fc_sel = optim.SGD([{'params': self.net.fc_selector.parameters(),
-                                      'lr': self.args.lr_classifier,
-                                      'momentum': self.args.momentum_classifier,
-                                      'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_fc_sel = optim.lr_scheduler.StepLR(self.opt_fc_sel, step_size=self.args.step_size,
-                                                    gamma=self.args.gamma)
-
-        self.opt_cos_clf = optim.SGD([{'params': self.net.cosnorm_classifier.parameters(),
-                                       'lr': self.args.lr_classifier,
-                                       'momentum': self.args.momentum_classifier,
-                                       'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_cos_clf = optim.lr_scheduler.StepLR(self.opt_cos_clf, step_size=self.args.step_size,
-                                                     gamma=self.args.gamma)
-
-        self.opt_mem = optim.SGD([{'params': self.net.criterion_ctr.parameters(),
-                                   'lr': self.args.lr_memory,
-                                   'momentum': self.args.momentum_memory,
-                                   'weight_decay': self.args.weight_decay_memory}])
-        self.sch_mem = optim.lr_scheduler.StepLR(self.opt_mem, step_size=self.args.step_size,
-                                                 gamma=self.args.gamma)
+        # A single optimizer updates all components with fused multi-tensor kernels
+        self.opt_net = optim.SGD(net_optim_params_list, foreach=True)
+        self.scheduler = optim.lr_scheduler.StepLR(self.opt_net, step_size=self.args.step_size, gamma=self.args.gamma)
 
     def reset_trainloader(self):
 
@@ -209,77 +213,67 @@ class OLTR(Algorithm):
                                              GTPS_mode='both')
 
 
+        # Up-sampled and plain loaders only differ in sampling, so they share one dataset each
+        self.logger.info('\nTRAINSET_GT....')
+        trainset_gt = get_dataset(name=self.args.dataset_name,
+                                  rootdir=self.args.dataset_root,
+                                  class_indices=cls_idx,
+                                  dset='train',
+                                  transform='train_strong',
+                                  conf_preds=self.conf_preds,
+                                  pseudo_labels_hard=None,
+                                  pseudo_labels_soft=self.pseudo_labels_soft,
+                                  GTPS_mode='GT',
+                                  blur=True)
+
+        self.logger.info('\nTRAINSET_PS....')
+        trainset_ps = get_dataset(name=self.args.dataset_name,
+                                  rootdir=self.args.dataset_root,
+                                  class_indices=cls_idx,
+                                  dset='train',
+                                  transform='train_strong',
+                                  conf_preds=self.conf_preds,
+                                  pseudo_labels_hard=self.pseudo_labels_hard,
+                                  pseudo_labels_soft=self.pseudo_labels_soft,
+                                  GTPS_mode='PS',
+                                  blur=True)
+
         self.logger.info('\nTRAINLOADER_UP_GT....')
-        self.trainloader_up_gt = load_dataset(name=self.args.dataset_name,
-                                              class_indices=cls_idx,
-                                              dset='train',
-                                              transform='train_strong',
-                                              rootdir=self.args.dataset_root,
-                                              batch_size=int(self.args.batch_size / 2),
-                                              shuffle=False,  # Here
-                                              num_workers=self.args.num_workers,
-                                              cas_sampler=True,  # Here
-                                              conf_preds=self.conf_preds,
-                                              pseudo_labels_hard=None,
-                                              pseudo_labels_soft=self.pseudo_labels_soft,
-                                              GTPS_mode='GT',
-                                              blur=True)
+        self.trainloader_up_gt = get_loader(trainset_gt,
+                                            batch_size=int(self.args.batch_size / 2),
+                                            shuffle=False,  # Here
+                                            num_workers=self.args.num_workers,
+                                            persistent_workers=True,
+                                            cas_sampler=True)  # Here
 
         self.logger.info('\nTRAINLOADER_UP_PS....')
-        self.trainloader_up_ps = load_dataset(name=self.args.dataset_name,
-                                              class_indices=cls_idx,
-                                              dset='train',
-                                              transform='train_strong',
-                                              rootdir=self.args.dataset_root,
-                                              batch_size=int(self.args.batch_size / 2),
-                                              shuffle=False,  # Here
-                                              num_workers=self.args.num_workers,
-                                              cas_sampler=True,  # Here
-                                              conf_preds=self.conf_preds,
-                                              pseudo_labels_hard=self.pseudo_labels_hard,
-                                              pseudo_labels_soft=self.pseudo_labels_soft,
-                                              GTPS_mode='PS',
-                                              blur=True)
+        self.trainloader_up_ps = get_loader(trainset_ps,
+                                            batch_size=int(self.args.batch_size / 2),
+                                            shuffle=False,  # Here
+                                            num_workers=self.args.num_workers,
+                                            persistent_workers=True,
+                                            cas_sampler=True)  # Here
 
         self.logger.info('\nTRAINLOADER_NO_UP_GT....')
-        self.trainloader_no_up_gt = load_dataset(name=self.args.dataset_name,
-                                                 class_indices=cls_idx,
-                                                 dset='train',
-                                                 transform='train_strong',
-                                                 rootdir=self.args.dataset_root,
-                                                 batch_size=int(self.args.batch_size / 2),
-                                                 shuffle=True,  # Here
-                                                 num_workers=self.args.num_workers,
-                                                 cas_sampler=False,  # Here
-                                                 conf_preds=self.conf_preds,
-                                                 pseudo_labels_hard=None,
-                                                 pseudo_labels_soft=self.pseudo_labels_soft,
-                                                 GTPS_mode='GT',
-                                                 blur=True)
+        self.trainloader_no_up_gt = get_loader(trainset_gt,
+                                               batch_size=int(self.args.batch_size / 2),
+                                               shuffle=True,  # Here
+                                               num_workers=self.args.num_workers,
+                                               persistent_workers=True,
+                                               cas_sampler=False)  # Here
 
         self.logger.info('\nTRAINLOADER_NO_UP_PS....')
-        self.trainloader_no_up_ps = load_dataset(name=self.args.dataset_name,
-                                                 class_indices=cls_idx,
-                                                 dset='train',
-                                                 transform='train_strong',
-                                                 rootdir=self.args.dataset_root,
-                                                 batch_size=int(self.args.batch_size / 2),
-                                                 shuffle=True,  # Here
-                                                 num_workers=self.args.num_workers,
-                                                 cas_sampler=False,  # Here
-                                                 conf_preds=self.conf_preds,
-                                                 pseudo_labels_hard=self.pseudo_labels_hard,
-                                                 pseudo_labels_soft=self.pseudo_labels_soft,
-                                                 GTPS_mode='PS',
-                                                 blur=True)
+        self.trainloader_no_up_ps = get_loader(trainset_ps,
+                                               batch_size=int(self.args.batch_size / 2),
+                                               shuffle=True,  # Here
+                                               num_workers=self.args.num_workers,
+                                               persistent_workers=True,
+                                               cas_sampler=False)  # Here
 
     def pseudo_label_reset(self, loader, hall=False, hard=False, soft=False):
         self.net.eval()
         total_preds, total_labels, total_logits, conf_preds = self.evaluate_forward(loader, hall=hall, 
                                                                                     ood=False, out_conf=True)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
-        total_logits = np.concatenate(total_logits, axis=0)
 
         if hard:
             self.logger.info("** Reseting hard pseudo labels **\n")
@@ -335,12 +329,13 @@ class OLTR(Algorithm):
                                  .format(best_acc_mac * 100, best_acc_mic * 100, best_epoch, best_semi_iter))
 
             # Revert to best weights
-            self.net.load_state_dict(copy.deepcopy(self.net.best_weights))
+            self.net.load_state_dict(self.net.best_weights)
 
-            # Reset pseudo labels
-            self.pseudo_label_reset(self.trainloader_eval, hall=False, soft=True, hard=True)
+            # Reset pseudo labels, only needed if another semi-iteration follows
+            if semi_i < self.args.semi_iters - 1:
+                self.pseudo_label_reset(self.trainloader_eval, hall=False, soft=True, hard=True)
 
-            self.set_optimizers()
+                self.set_optimizers()
 
             self.logger.info('\nBest Model Appears at Epoch {} Semi-iteration {} with Mac Acc {:.3f} (Mic {:.3f})...'
                              .format(best_epoch, best_semi_iter, best_acc_mac * 100, best_acc_mic * 100))
@@ -406,13 +401,6 @@ class OLTR(Algorithm):
 
         for batch_idx in range(N):
 
-            # log basic adda train info
-            info_str = '[Memory training (Stage 2)] '
-            info_str += '[Soft] ' if soft else '[Hard] '
-            info_str += '[up] ' if up else '[no_up] '
-            info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
-                                                              N, 100 * batch_idx / N)
-
             try:
                 data_gt, labels_gt, soft_target_gt = next(iter_gt)
             except StopIteration:
@@ -421,7 +409,6 @@ class OLTR(Algorithm):
 
             data_ps, labels_ps, soft_target_ps = next(iter_ps)
 
-            data = torch.cat((data_gt, data_ps), dim=0)
             labels = torch.cat((labels_gt, labels_ps), dim=0)
             soft_target = torch.cat((soft_target_gt, soft_target_ps), dim=0)
 
@@ -429,7 +416,9 @@ class OLTR(Algorithm):
             # Setup data variables #
             ########################
             # assign devices
-            data, labels, soft_target = data.cuda(), labels.cuda(), soft_target.cuda()
+            data = self.stage_input(data_gt, data_ps)
+            labels = labels.cuda(non_blocking=True)
+            soft_target = soft_target.cuda(non_blocking=True)
             data.requires_grad = False
             labels.requires_grad = False
             soft_target.requires_grad = False
@@ -440,49 +429,42 @@ class OLTR(Algorithm):
 
             feats, logits, _, _ = self.memory_forward(data)
 
-            preds = logits.argmax(dim=1)
-
             # calculate loss
             if soft:
                 xent_loss = self.net.criterion_cls_soft(logits, labels, soft_target)
             else:
                 xent_loss = self.net.criterion_cls_hard(logits, labels)
-            ctr_loss = self.net.criterion_ctr(feats.clone(), labels)
+            ctr_loss = self.net.criterion_ctr(feats, labels)
             loss = xent_loss + self.args.ctr_loss_weight * ctr_loss
 
             #############################
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_feats.zero_grad()
-            self.opt_fc_hall.zero_grad()
-            self.opt_fc_sel.zero_grad()
-            self.opt_cos_clf.zero_grad()
-            self.opt_mem.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
-            self.opt_feats.step()
-            self.opt_fc_hall.step()
-            self.opt_fc_sel.step()
-            self.opt_cos_clf.step()
-            self.opt_mem.step()
+            self.opt_net.step()
 
             ###########
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[Memory training (Stage 2)] '
+                info_str += '[Soft] ' if soft else '[Hard] '
+                info_str += '[up] ' if up else '[no_up] '
+                info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
+                                                                  N, 100 * batch_idx / N)
                 # compute overall acc
+                preds = logits.argmax(dim=1)
                 acc = (preds == labels).float().mean()
                 # log update info
                 info_str += 'Acc: {:0.1f} Xent: {:.3f}'.format(acc.item() * 100, loss.item())
                 self.logger.info(info_str)
 
-        self.sch_feats.step()
-        self.sch_fc_hall.step()
-        self.sch_fc_sel.step()
-        self.sch_cos_clf.step()
-        self.sch_mem.step()
+        self.scheduler.step()
 
     def evaluate_epoch(self, loader, hall=False):
         self.net.eval()
@@ -490,8 +472,6 @@ class OLTR(Algorithm):
         loader_uni_class, eval_class_counts = loader.dataset.class_counts_cal()
         total_preds, total_labels, _, _ = self.evaluate_forward(loader, hall=hall, 
                                                                 ood=False, out_conf=False)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_labels = np.concatenate(total_labels, axis=0)
         eval_info, mac_acc, mic_acc = self.evaluate_metric(total_preds, total_labels, 
                                                            eval_class_counts, ood=False)
         return eval_info, mac_acc, mic_acc
@@ -505,16 +485,10 @@ class OLTR(Algorithm):
         self.logger.info("Forward through in test loader\n")
         total_preds_in, total_labels_in, _, total_ids_in = self.evaluate_forward(loader_in, hall=hall,
                                                                                  ood=True, out_conf=False)
-        total_preds_in = np.concatenate(total_preds_in, axis=0)
-        total_labels_in = np.concatenate(total_labels_in, axis=0)
-        total_ids_in = np.concatenate(total_ids_in, axis=0)
 
         self.logger.info("Forward through out test loader\n")
         total_preds_out, total_labels_out, _, total_ids_out = self.evaluate_forward(loader_out, hall=hall,
                                                                                     ood=True, out_conf=False)
-        total_preds_out = np.concatenate(total_preds_out, axis=0)
-        total_labels_out = np.concatenate(total_labels_out, axis=0)
-        total_ids_out = np.concatenate(total_ids_out, axis=0)
 
         total_preds = np.concatenate((total_preds_out, total_preds_in), axis=0)
         total_labels = np.concatenate((total_labels_out, total_labels_in), axis=0)
@@ -537,13 +511,12 @@ class OLTR(Algorithm):
         total_file_id = []
         total_preds = []
         total_max_probs = []
-        total_feats = []
 
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
             for data, file_id in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data = data.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
                 data.requires_grad = False
 
                 # forward
@@ -552,15 +525,14 @@ class OLTR(Algorithm):
                 # compute correct
                 max_probs, preds = F.softmax(logits, dim=1).max(dim=1)
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_max_probs.append(max_probs.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_max_probs.append(max_probs)
                 total_file_id.append(file_id)
-                total_feats.append(meta_feats.detach().cpu().numpy())
 
+        # Results stay on device during the loop and are copied to host once
         total_file_id = np.concatenate(total_file_id, axis=0)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_max_probs = np.concatenate(total_max_probs, axis=0)
-        total_feats = np.concatenate(total_feats, axis=0)
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_max_probs = torch.cat(total_max_probs).cpu().numpy()
 
         eval_info = '{} Picking Non-empty samples... \n'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
 
@@ -596,38 +568,32 @@ class OLTR(Algorithm):
         return eval_info, (total_file_id_conf, total_preds_conf), (total_file_id_unconf, total_preds_unconf)
 
     def memory_forward(self, data):
-        # feature
-        feats = self.net.feature(data)
-
-        batch_size = feats.size(0)
-        feat_size = feats.size(1)
+        # feature, only the backbone runs in reduced precision
+        with self.autocast():
+            feats = self.net.feature(data)
+        feats = feats.float()
 
         # get current centroids and detach it from graph
-        centroids = self.net.criterion_ctr.centroids.clone().detach()
-        centroids.requires_grad = False
+        centroids = self.net.criterion_ctr.centroids.detach()
 
         # set up visual memory
-        feats_expand = feats.clone().unsqueeze(1).expand(-1, self.net.num_cls, -1)
-        centroids_expand = centroids.clone().unsqueeze(0).expand(batch_size, -1, -1)
-        keys_memory = centroids.clone()
+        keys_memory = centroids
 
         # computing reachability
-        dist_cur = torch.norm(feats_expand - centroids_expand, 2, 2)
-        values_nn, labels_nn = torch.sort(dist_cur, 1)
-
-        reachability = (self.args.reachability_scale / values_nn[:, 0]).unsqueeze(1).expand(-1, feat_size)
+        dist_cur = torch.cdist(feats, centroids, p=2)
+        values_nn, _ = dist_cur.min(dim=1)
 
         # computing memory feature by querying and associating visual memory
-        values_memory = self.net.fc_hallucinator(feats.clone())
+        values_memory = self.net.fc_hallucinator(feats)
         values_memory = values_memory.softmax(dim=1)
         memory_feature = torch.matmul(values_memory, keys_memory)
 
         # computing concept selector
-        concept_selector = self.net.fc_selector(feats.clone())
-        concept_selector = concept_selector.tanh()
+        concept_selector = self.net.fc_selector(feats)
 
-        # computing meta embedding
-        meta_feats = reachability * (feats + concept_selector * memory_feature)
+        # computing meta embedding with reachability
+        meta_feats = meta_embedding(feats, values_nn, concept_selector, memory_feature,
+                                    float(self.args.reachability_scale))
 
         # final logits
         logits = self.net.cosnorm_classifier(meta_feats)
@@ -646,19 +612,22 @@ class OLTR(Algorithm):
         total_file_ids = []
 
         # Forward and record # correct predictions of each class
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for data, labels, file_ids in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
                 # forward
                 if hall:
-                    feats = self.net.feature(data)
-                    logits = self.net.fc_hallucinator(feats)
+                    with self.autocast():
+                        feats = self.net.feature(data)
+                        logits = self.net.fc_hallucinator(feats)
+                    logits = logits.float()
                 else:
                     # forward
                     feats, logits, values_nn, meta_feats = self.memory_forward(data)
@@ -669,14 +638,20 @@ class OLTR(Algorithm):
                     # Set unconfident prediction to -1
                     preds[max_probs < self.args.theta] = -1
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_logits.append(logits.detach().cpu().numpy())
-                total_probs.append(max_probs.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_logits.append(logits)
+                total_probs.append(max_probs)
                 total_file_ids.append(file_ids)
 
+        # Results stay on device during the loop and are copied to host once
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_logits = torch.cat(total_logits).cpu().numpy()
+        total_file_ids = np.concatenate(total_file_ids, axis=0)
+
         if out_conf:
-            total_probs = np.concatenate(total_probs, axis=0)
+            total_probs = torch.cat(total_probs).cpu().numpy()
             conf_preds = np.zeros(len(total_probs))
             conf_preds[total_probs >= self.args.theta] = 1
             return total_preds, total_labels, total_logits, conf_preds
@@ -744,26 +719,26 @@ class OLTR(Algorithm):
         centroids = torch.zeros(len(class_indices[self.args.class_indices]),
                                 self.net.feature_dim).cuda()
 
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for batch in tqdm(loader, total=len(loader)):
 
                 data, labels = batch
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
                 # forward
-                feats = self.net.feature(data)
+                with self.autocast():
+                    feats = self.net.feature(data)
                 # Add all calculated features to center tensor
-                for i in range(len(labels)):
-                    label = labels[i]
-                    centroids[label] += feats[i]
+                centroids.index_add_(0, labels.long(), feats.float())
 
         # Get data counts
         _, loader_class_counts = loader.dataset.class_counts_cal()
         # Average summed features with class count
-        centroids /= torch.tensor(loader_class_counts).float().unsqueeze(1).cuda()
+        centroids /= torch.as_tensor(loader_class_counts, dtype=torch.float32, device=centroids.device).unsqueeze(1)
 
         return centroids
 
@@ -1,6 +1,5 @@
 import os
 import numpy as np
-import copy
 from datetime import datetime
 from tqdm import tqdm
 
@@ -10,7 +9,7 @@ import torch.nn.functional as F
 
 from .utils import register_algorithm, Algorithm, acc, WarmupScheduler, ood_metric
 # from .plain_memory_stage_2_conf_pseu import PlainMemoryStage2_ConfPseu
-from src.data.utils import load_dataset
+from src.data.utils import load_dataset, get_dataset, get_loader
 from src.data.class_indices import class_indices
 from src.models.utils import get_model
 from src.algorithms.stage_2_pslabel_oltr import OLTR
@@ -41,6 +40,7 @@ class OLTR_Energy(OLTR):
                                                batch_size=self.args.batch_size * 2,
                                                shuffle=True,
                                                num_workers=self.args.num_workers,
+                                               persistent_workers=True,
                                                cas_sampler=False)
 
         ###########################
@@ -54,6 +54,7 @@ class OLTR_Energy(OLTR):
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.args.weights_init, num_layers=self.args.num_layers,
                              init_feat_only=False, T=self.args.T, alpha=self.args.alpha)
+        self.compile_net()
 
         self.set_optimizers()
 
@@ -85,6 +86,7 @@ class OLTR_Energy(OLTR):
         self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
                              weights_init=self.weights_path.replace('.pth', '_ft.pth'),
                              num_layers=self.args.num_layers, init_feat_only=False)
+        self.compile_net()
 
         # self.net = get_model(name=self.args.model_name, num_cls=len(class_indices[self.args.class_indices]),
         #                      weights_init=self.args.weights_init,
@@ -108,40 +110,32 @@ class OLTR_Energy(OLTR):
         ######################
         # Optimization setup #
         ######################
+        # Setup optimizer parameters for each network component
+        net_optim_params_list = [
+            {'params': self.net.feature.parameters(),
+             'lr': self.args.lr_feature,
+             'momentum': self.args.momentum_feature,
+             'weight_decay': self.args.weight_decay_feature},
+            {'params': self.net.fc_hallucinator.parameters(),
+             'lr': self.args.lr_classifier * 0.1,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.fc_selector.parameters(),
+             'lr': self.args.lr_classifier,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.cosnorm_classifier.parameters(),
+             'lr': self.args.lr_classifier,
+             'momentum': self.args.momentum_classifier,
+             'weight_decay': self.args.weight_decay_classifier},
+            {'params': self.net.criterion_ctr.parameters(),
+             'lr': self.args.lr_memory,
+             'momentum': self.args.momentum_memory,
+             'weight_decay': self.args.weight_decay_memory}
+        ]
         # Setup optimizer and optimizer scheduler
-        self.opt_feats = optim.SGD([{'params': self.net.feature.parameters(),
-                                     'lr': self.args.lr_feature,
-                                     'momentum': self.args.momentum_feature,
-                                     'weight_decay': self.args.weight_decay_feature}])
-        self.sch_feats = cosine_scheduler(self.opt_feats, self.args.num_epochs, 
-                                          len(self.trainloader_eval), self.args.lr_feature)
-
-        self.opt_fc_hall = optim.SGD([{'params': self.net.fc_hallucinator.parameters(),
-                                       'lr': self.args.lr_classifier * 0.1,
-                                       'momentum': self.args.momentum_classifier,
-                                       'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_fc_hall = cosine_scheduler(self.opt_fc_hall, self.args.num_epochs, 
-                                          len(self.trainloader_eval), self.args.lr_feature)
-
-        self.opt_fc_sel = optim.SGD([{'params': self.net.fc_selector.parameters(),
-                                      'lr': self.args.lr_classifier,
-                                      'momentum': self.args.momentum_classifier,
-                                      'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_fc_sel = cosine_scheduler(self.opt_fc_sel, self.args.num_epochs, 
-                                          len(self.trainloader_eval), self.args.lr_feature)
-
-        self.opt_cos_clf = optim.SGD([{'params': self.net.cosnorm_classifier.parameters(),
-                                       'lr': self.args.lr_classifier,
-                                       'momentum': self.args.momentum_classifier,
-                                       'weight_decay': self.args.weight_decay_classifier}])
-        self.sch_cos_clf = cosine_scheduler(self.opt_cos_clf, self.args.num_epochs, 
-                                          len(self.trainloader_eval), self.args.lr_feature)
-
-        self.opt_mem = optim.SGD([{'params': self.net.criterion_ctr.parameters(),
-                                   'lr': self.args.lr_memory,
-                                   'momentum': self.args.momentum_memory,
-                                   'weight_decay': self.args.weight_decay_memory}])
-        self.sch_mem = cosine_scheduler(self.opt_mem, self.args.num_epochs, 
+        self.opt_net = optim.SGD(net_optim_params_list, foreach=True)
+        self.scheduler = cosine_scheduler(self.opt_net, self.args.num_epochs,
                                           len(self.trainloader_eval), self.args.lr_feature)
 
     def reset_trainloader(self):
@@ -165,69 +159,62 @@ class OLTR_Energy(OLTR):
                                              pseudo_labels_soft=None,
                                              GTPS_mode='both')
 
+        # Up-sampled and plain loaders only differ in sampling, so they share one dataset each
+        self.logger.info('\nTRAINSET_GT....')
+        trainset_gt = get_dataset(name=self.args.dataset_name,
+                                  rootdir=self.args.dataset_root,
+                                  class_indices=cls_idx,
+                                  dset='train',
+                                  transform='train_strong',
+                                  conf_preds=self.conf_preds,
+                                  pseudo_labels_hard=None,
+                                  pseudo_labels_soft=None,
+                                  GTPS_mode='GT',
+                                  blur=True)
+
+        self.logger.info('\nTRAINSET_PS....')
+        trainset_ps = get_dataset(name=self.args.dataset_name,
+                                  rootdir=self.args.dataset_root,
+                                  class_indices=cls_idx,
+                                  dset='train',
+                                  transform='train_strong',
+                                  conf_preds=self.conf_preds,
+                                  pseudo_labels_hard=self.pseudo_labels_hard,
+                                  pseudo_labels_soft=None,
+                                  GTPS_mode='PS',
+                                  blur=True)
+
         self.logger.info('\nTRAINLOADER_UP_GT....')
-        self.trainloader_up_gt = load_dataset(name=self.args.dataset_name,
-                                              class_indices=cls_idx,
-                                              dset='train',
-                                              transform='train_strong',
-                                              rootdir=self.args.dataset_root,
-                                              batch_size=int(self.args.batch_size / 2),
-                                              shuffle=False,  # Here
-                                              num_workers=self.args.num_workers,
-                                              cas_sampler=True,  # Here
-                                              conf_preds=self.conf_preds,
-                                              pseudo_labels_hard=None,
-                                              pseudo_labels_soft=None,
-                                              GTPS_mode='GT',
-                                              blur=True)
+        self.trainloader_up_gt = get_loader(trainset_gt,
+                                            batch_size=int(self.args.batch_size / 2),
+                                            shuffle=False,  # Here
+                                            num_workers=self.args.num_workers,
+                                            persistent_workers=True,
+                                            cas_sampler=True)  # Here
 
         self.logger.info('\nTRAINLOADER_UP_PS....')
-        self.trainloader_up_ps = load_dataset(name=self.args.dataset_name,
-                                              class_indices=cls_idx,
-                                              dset='train',
-                                              transform='train_strong',
-                                              rootdir=self.args.dataset_root,
-                                              batch_size=int(self.args.batch_size / 2),
-                                              shuffle=False,  # Here
-                                              num_workers=self.args.num_workers,
-                                              cas_sampler=True,  # Here
-                                              conf_preds=self.conf_preds,
-                                              pseudo_labels_hard=self.pseudo_labels_hard,
-                                              pseudo_labels_soft=None,
-                                              GTPS_mode='PS',
-                                              blur=True)
+        self.trainloader_up_ps = get_loader(trainset_ps,
+                                            batch_size=int(self.args.batch_size / 2),
+                                            shuffle=False,  # Here
+                                            num_workers=self.args.num_workers,
+                                            persistent_workers=True,
+                                            cas_sampler=True)  # Here
 
         self.logger.info('\nTRAINLOADER_NO_UP_GT....')
-        self.trainloader_no_up_gt = load_dataset(name=self.args.dataset_name,
-                                                 class_indices=cls_idx,
-                                                 dset='train',
-                                                 transform='train_strong',
-                                                 rootdir=self.args.dataset_root,
-                                                 batch_size=int(self.args.batch_size / 2),
-                                                 shuffle=True,  # Here
-                                                 num_workers=self.args.num_workers,
-                                                 cas_sampler=False,  # Here
-                                                 conf_preds=self.conf_preds,
-                                                 pseudo_labels_hard=None,
-                                                 pseudo_labels_soft=self.pseudo_labels_soft,
-                                                 GTPS_mode='GT',
-                                                 blur=True)
+        self.trainloader_no_up_gt = get_loader(trainset_gt,
+                                               batch_size=int(self.args.batch_size / 2),
+                                               shuffle=True,  # Here
+                                               num_workers=self.args.num_workers,
+                                               persistent_workers=True,
+                                               cas_sampler=False)  # Here
 
         self.logger.info('\nTRAINLOADER_NO_UP_PS....')
-        self.trainloader_no_up_ps = load_dataset(name=self.args.dataset_name,
-                                                 class_indices=cls_idx,
-                                                 dset='train',
-                                                 transform='train_strong',
-                                                 rootdir=self.args.dataset_root,
-                                                 batch_size=int(self.args.batch_size / 2),
-                                                 shuffle=True,  # Here
-                                                 num_workers=self.args.num_workers,
-                                                 cas_sampler=False,  # Here
-                                                 conf_preds=self.conf_preds,
-                                                 pseudo_labels_hard=self.pseudo_labels_hard,
-                                                 pseudo_labels_soft=self.pseudo_labels_soft,
-                                                 GTPS_mode='PS',
-                                                 blur=True)
+        self.trainloader_no_up_ps = get_loader(trainset_ps,
+                                               batch_size=int(self.args.batch_size / 2),
+                                               shuffle=True,  # Here
+                                               num_workers=self.args.num_workers,
+                                               persistent_workers=True,
+                                               cas_sampler=False)  # Here
 
     def energy_ft(self):
         best_f1 = 0
@@ -274,13 +261,6 @@ class OLTR_Energy(OLTR):
 
         for batch_idx in range(N):
 
-            # log basic adda train info
-            info_str = '[Energy Memory training (Stage 2)] '
-            info_str += '[Hard] '
-            info_str += '[up] ' if up else '[no_up] '
-            info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
-                                                              N, 100 * batch_idx / N)
-            
             # IN
             try:
                 data_gt, labels_gt = next(iter_gt)
@@ -290,7 +270,6 @@ class OLTR_Energy(OLTR):
 
             data_ps, labels_ps = next(iter_ps)
 
-            data_in = torch.cat((data_gt, data_ps), dim=0)
             labels = torch.cat((labels_gt, labels_ps), dim=0)
 
             # OUT
@@ -300,13 +279,12 @@ class OLTR_Energy(OLTR):
                 out_iter = iter(self.trainloaderunknown)
                 data_out, _ = next(out_iter)
 
-            data = torch.cat((data_in, data_out), dim=0)
-
             ########################
             # Setup data variables #
             ########################
             # assign devices
-            data, labels = data.cuda(), labels.cuda()
+            data = self.stage_input(data_gt, data_ps, data_out)
+            labels = labels.cuda(non_blocking=True)
             data.requires_grad = False
             labels.requires_grad = False
 
@@ -316,17 +294,15 @@ class OLTR_Energy(OLTR):
 
             feats, logits, _, _ = self.memory_forward(data)
 
-            preds = logits.argmax(dim=1)
-
             # calculate oltr loss
-            xent_loss = self.net.criterion_cls_hard(logits[:len(data_in)], labels)
-            ctr_loss = self.net.criterion_ctr(feats[:len(data_in)].clone(), labels)
+            xent_loss = self.net.criterion_cls_hard(logits[:len(labels)], labels)
+            ctr_loss = self.net.criterion_ctr(feats[:len(labels)], labels)
 
             oltr_loss = xent_loss + self.args.ctr_loss_weight * ctr_loss
 
             # calculate energy loss
-            Ec_out = -torch.logsumexp(logits[len(data_in):], dim=1)
-            Ec_in = -torch.logsumexp(logits[:len(data_in)], dim=1)
+            Ec_out = -torch.logsumexp(logits[len(labels):], dim=1)
+            Ec_in = -torch.logsumexp(logits[:len(labels)], dim=1)
             m_out = -7.
             m_in = -18.
             eb_loss = torch.pow(F.relu(Ec_in - m_in), 2).mean() + torch.pow(F.relu(m_out - Ec_out), 2).mean()
@@ -338,32 +314,25 @@ class OLTR_Energy(OLTR):
             # Backward and optimization #
             #############################
             # zero gradients for optimizer
-            self.opt_feats.zero_grad()
-            self.opt_fc_hall.zero_grad()
-            self.opt_fc_sel.zero_grad()
-            self.opt_cos_clf.zero_grad()
-            self.opt_mem.zero_grad()
+            self.opt_net.zero_grad(set_to_none=True)
             # loss backpropagation
             loss.backward()
             # optimize step
-            self.opt_feats.step()
-            self.opt_fc_hall.step()
-            self.opt_fc_sel.step()
-            self.opt_cos_clf.step()
-            self.opt_mem.step()
-
-            self.sch_feats.step()
-            self.sch_fc_hall.step()
-            self.sch_fc_sel.step()
-            self.sch_cos_clf.step()
-            self.sch_mem.step()
+            self.opt_net.step()
+            self.scheduler.step()
 
             ###########
             # Logging #
             ###########
             if batch_idx % self.log_interval == 0:
+                # log basic adda train info
+                info_str = '[Energy Memory training (Stage 2)] '
+                info_str += '[Hard] '
+                info_str += '[up] ' if up else '[no_up] '
+                info_str += 'Epoch: {} [{}/{} ({:.2f}%)] '.format(epoch, batch_idx,
+                                                                  N, 100 * batch_idx / N)
                 # compute overall acc
-                preds = logits[:len(data_in)].argmax(dim=1)
+                preds = logits[:len(labels)].argmax(dim=1)
                 acc = (preds == labels).float().mean()
                 # log update info
                 info_str += 'Acc: {:0.1f} Oltr: {:.3f}, EB: {:.3f}'.format(acc.item() * 100, oltr_loss.item(),
@@ -395,27 +364,28 @@ class OLTR_Energy(OLTR):
         total_logits = []
         total_probs = []
         total_file_id = []
-        total_feats = []
         total_energy = []
 
         # Forward and record # correct predictions of each class
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
 
             for data, labels, file_id in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data, labels = data.cuda(), labels.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
                 data.requires_grad = False
                 labels.requires_grad = False
 
                 # forward
                 if hall:
-                    feats = self.net.feature(data)
-                    logits = self.net.fc_hallucinator(feats)
+                    with self.autocast():
+                        feats = self.net.feature(data)
+                        logits = self.net.fc_hallucinator(feats)
+                    logits = logits.float()
                 else:
                     # forward
                     feats, logits, values_nn, meta_feats = self.memory_forward(data)
-                    total_feats.append(meta_feats.detach().cpu().numpy())
 
                 max_probs, preds = F.softmax(logits, dim=1).max(dim=1)
 
@@ -425,11 +395,11 @@ class OLTR_Energy(OLTR):
                     # Set unconfident prediction to -1
                     preds[-energy_score <= self.args.energy_the] = -1
 
-                total_energy.append(energy_score.detach().cpu().numpy())
-                total_preds.append(preds.detach().cpu().numpy())
-                total_labels.append(labels.detach().cpu().numpy())
-                total_logits.append(logits.detach().cpu().numpy())
-                total_probs.append(max_probs.detach().cpu().numpy())
+                total_energy.append(energy_score)
+                total_preds.append(preds)
+                total_labels.append(labels)
+                total_logits.append(logits)
+                total_probs.append(max_probs)
                 total_file_id.append(file_id)
 
         # total_energy = np.concatenate(total_energy, axis=0)
@@ -443,8 +413,14 @@ class OLTR_Energy(OLTR):
         #          total_labels=total_labels)
         # breakpoint()
 
+        # Results stay on device during the loop and are copied to host once
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_labels = torch.cat(total_labels).cpu().numpy()
+        total_logits = torch.cat(total_logits).cpu().numpy()
+        total_file_id = np.concatenate(total_file_id, axis=0)
+
         if out_conf:
-            total_probs = np.concatenate(total_probs, axis=0)
+            total_probs = torch.cat(total_probs).cpu().numpy()
             conf_preds = np.zeros(len(total_probs))
             conf_preds[total_probs >= self.args.theta] = 1
             return total_preds, total_labels, total_logits, conf_preds
@@ -458,13 +434,12 @@ class OLTR_Energy(OLTR):
         total_max_probs = []
         total_energy = []
         total_probs = []
-        total_feats = []
 
-        with torch.set_grad_enabled(False):
+        with torch.inference_mode():
             for data, file_id in tqdm(loader, total=len(loader)):
 
                 # setup data
-                data = data.cuda()
+                data = data.cuda(non_blocking=True).to(memory_format=torch.channels_last)
                 data.requires_grad = False
 
                 # forward
@@ -476,19 +451,18 @@ class OLTR_Energy(OLTR):
 
                 energy_score = -(self.args.energy_T * torch.logsumexp(logits / self.args.energy_T, dim=1))
 
-                total_preds.append(preds.detach().cpu().numpy())
-                total_max_probs.append(max_probs.detach().cpu().numpy())
+                total_preds.append(preds)
+                total_max_probs.append(max_probs)
                 total_file_id.append(file_id)
-                total_energy.append(energy_score.detach().cpu().numpy())
-                total_probs.append(probs.detach().cpu().numpy())
-                total_feats.append(meta_feats.detach().cpu().numpy())
+                total_energy.append(energy_score)
+                total_probs.append(probs)
 
+        # Results stay on device during the loop and are copied to host once
         total_file_id = np.concatenate(total_file_id, axis=0)
-        total_preds = np.concatenate(total_preds, axis=0)
-        total_max_probs = np.concatenate(total_max_probs, axis=0)
-        total_energy = np.concatenate(total_energy, axis=0)
-        total_probs = np.concatenate(total_probs, axis=0)
-        total_feats = np.concatenate(total_feats, axis=0)
+        total_preds = torch.cat(total_preds).cpu().numpy()
+        total_max_probs = torch.cat(total_max_probs).cpu().numpy()
+        total_energy = torch.cat(total_energy).cpu().numpy()
+        total_probs = torch.cat(total_probs).cpu().numpy()
 
         eval_info = '{} Picking Non-empty samples... \n'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"))
 
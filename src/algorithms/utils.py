@@ -1,5 +1,4 @@
 import numpy as np
-from copy import deepcopy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -35,6 +34,7 @@ class Algorithm:
     """
 
     name = None
+    input_buffer = None
 
     def __init__(self, args):
         self.args = args
@@ -65,6 +65,33 @@ class Algorithm:
     def save_model(self):
         pass
 
+    def compile_net(self):
+        # Compilation is skipped when CUDA graphs are requested
+        if self.args.compile and not self.args.cuda_graph:
+            self.logger.info('** COMPILING FEATURE NETWORK!!! **')
+            self.net.feature.compile(mode='reduce-overhead')
+
+    def stage_input(self, *chunks):
+        # Copy sub-batches into slices of a reused device buffer instead of concatenating on host
+        size = sum(len(c) for c in chunks)
+        if (self.input_buffer is None or len(self.input_buffer) < size
+                or self.input_buffer.shape[1:] != chunks[0].shape[1:]):
+            self.input_buffer = torch.empty((size,) + tuple(chunks[0].shape[1:]),
+                                            dtype=chunks[0].dtype, device='cuda',
+                                            memory_format=torch.channels_last)
+        # Slicing along the batch dimension keeps the buffer channels_last
+        data = self.input_buffer[:size]
+        start = 0
+        for c in chunks:
+            data[start:start + len(c)].copy_(c, non_blocking=True)
+            start += len(c)
+        return data
+
+    def autocast(self):
+        # Graph capture cannot reuse the autocast weight cache
+        return torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.args.amp,
+                              cache_enabled=not self.args.cuda_graph)
+
 
 class WarmupScheduler:
     def __init__(self, optimizer, decay1, decay2, gamma, len_epoch, warmup_epochs=5, epi=1):
@@ -79,7 +106,7 @@ class WarmupScheduler:
 
         self.init_lr_list = []
         for param_group in self.optimizer.param_groups:
-            self.init_lr_list.append(deepcopy(param_group['lr']))
+            self.init_lr_list.append(param_group['lr'])
 
     # def step(self, epoch, step):
     def step(self):
@@ -108,11 +135,7 @@ def acc(preds, labels):
 
     _, label_counts = np.unique(labels, return_counts=True)
 
-    class_correct = np.array([0. for _ in range(len(label_counts))])
-
-    for p, l in zip(preds, labels):
-        if p == l:
-            class_correct[l] += 1
+    class_correct = np.bincount(labels[preds == labels], minlength=len(label_counts)).astype(float)
 
     class_acc = class_correct / label_counts
 
@@ -124,14 +147,12 @@ def acc(preds, labels):
 
 def f_measure(preds, labels):
     # f1 score for openset evaluation with close set accuracy
-    true_pos = 0.
-    false_pos = 0.
-    false_neg = 0.
+    known = labels != -1
+    wrong = preds != labels
 
-    for i in range(len(labels)):
-        true_pos += 1 if preds[i] == labels[i] and labels[i] != -1 else 0
-        false_pos += 1 if preds[i] != labels[i] and labels[i] != -1 else 0
-        false_neg += 1 if preds[i] != labels[i] and labels[i] == -1 else 0
+    true_pos = float(np.sum(~wrong & known))
+    false_pos = float(np.sum(wrong & known))
+    false_neg = float(np.sum(wrong & ~known))
 
     precision = true_pos / (true_pos + false_pos)
     recall = true_pos / (true_pos + false_neg)
@@ -140,26 +161,18 @@ def f_measure(preds, labels):
 
 def confident_metrics(preds, labels, class_counts):
     # Confident metrics
-    class_correct_confident = np.array([0. for _ in range(len(np.unique(labels)) - 1)])
-    class_select_confident = np.array([0. for _ in range(len(np.unique(labels)) - 1)])
+    num_cls = len(np.unique(labels)) - 1
     preds_confident = preds[preds != -1]
     labels_confident = labels[preds != -1]
 
-    false_pos_counts = 0.
+    known = labels_confident != -1
+    correct = known & (preds_confident == labels_confident)
 
-    # compute correct predictions in confident preds
-    for i in range(len(preds_confident)):
-        pred = preds_confident[i]
-        label = labels_confident[i]
-
-        if label != -1:
-            # Confident known accuracy
-            if pred == label:
-                class_correct_confident[label] += 1
-            class_select_confident[label] += 1
-        else:
-            # Counts of unknown in confident set
-            false_pos_counts += 1
+    # Confident known accuracy
+    class_correct_confident = np.bincount(labels_confident[correct], minlength=num_cls).astype(float)
+    class_select_confident = np.bincount(labels_confident[known], minlength=num_cls).astype(float)
+    # Counts of unknown in confident set
+    false_pos_counts = float(np.sum(~known))
 
     # Record per class accuracies for confident data
     class_acc_confident = class_correct_confident / class_select_confident
@@ -174,37 +187,21 @@ def unconfident_metrics(preds, labels):
 
     num_cls = len(np.unique(labels)) - 1
 
-    class_unconf_wrong = np.array([0. for _ in range(num_cls)])
-    class_wrong = np.array([1e-7 for _ in range(num_cls)])
-
-    for i in range(len(preds)):
-
-        pred = preds[i]
-        label = labels[i]
+    wrong = (preds != labels) & (labels != -1)
 
-        if pred != label and label != -1:
-            class_wrong[label] += 1
-            if pred == -1:
-                class_unconf_wrong[label] += 1
+    class_unconf_wrong = np.bincount(labels[wrong & (preds == -1)], minlength=num_cls).astype(float)
+    class_wrong = np.bincount(labels[wrong], minlength=num_cls) + 1e-7
 
     return class_unconf_wrong / class_wrong
 
 
 def unknown_metrics(preds, labels):
     # Unknown metrics
-    correct_unknown = 0.
-    total_unknown = 0.
-    preds_unknown = preds[labels == -1]
-    labels_unknown = labels[labels == -1]
-
-    for i in range(len(preds_unknown)):
-        pred = preds_unknown[i]
-        label = labels_unknown[i]
-        # record correctly picked unconfident samples
-        if pred == label:
-            correct_unknown += 1
-        # record all unconfident samples
-        total_unknown += 1
+    unknown = labels == -1
+    # record correctly picked unconfident samples
+    correct_unknown = float(np.sum(preds[unknown] == -1))
+    # record all unconfident samples
+    total_unknown = float(np.sum(unknown))
 
     percent_unknown = correct_unknown / total_unknown
 
@@ -221,8 +218,7 @@ def ood_metric(preds, labels, class_counts):
     # Open
     percent_unknown, total_unknown = unknown_metrics(preds, labels)
     # Confident indices
-    conf_preds = np.zeros(len(preds))
-    conf_preds[preds != -1] = 1
+    conf_preds = (preds != -1).astype(float)
     return (f1, class_acc_confident, class_percent_confident, false_pos_percent,
             class_wrong_unconfident, percent_unknown, total_unknown, total_known, conf_preds)
 
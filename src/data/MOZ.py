@@ -1,70 +1,69 @@
 import os
 import random
-from PIL import Image, ImageFilter
+from PIL import ImageFilter
 import numpy as np
-from copy import deepcopy
 
 import torch
 from torch.utils.data import Dataset
 
-from .utils import register_dataset_obj, BaseDataset
+from .utils import register_dataset_obj, BaseDataset, pil_loader
+
+split_lists = {}
+
+
+def read_split_list(ann_dir):
+    # Datasets are rebuilt whenever loaders are reset, so keep parsed lists in memory.
+    key = (ann_dir, os.path.getmtime(ann_dir))
+    if key not in split_lists:
+        with open(ann_dir, 'r') as f:
+            split_lists[key] = tuple(line.rstrip('\n') for line in f)
+    return split_lists[key]
 
 
 class MOZ(BaseDataset):
 
+    # Split list file name, formatted with dset
+    ann_template = None
+
     def __init__(self, rootdir, class_indices, dset='train', transform=None):
         super(MOZ, self).__init__(class_indices=class_indices, dset=dset, transform=transform)
         self.img_root = os.path.join(rootdir, 'Mozambique')
         self.ann_root = os.path.join(rootdir, 'Mozambique', 'SplitLists')
+        if self.ann_template is not None:
+            self.load_data(os.path.join(self.ann_root, self.ann_template.format(self.dset)))
 
     def load_data(self, ann_dir):
-        with open(ann_dir, 'r') as f:
-            for line in f:
-                line_sp = line.replace('\n', '').split(' ')
-
-                if line_sp[1] in self.class_indices.keys():
-                    label = self.class_indices[line_sp[1]]
-                else:
-                    label = -1
-
-                self.data.append(line_sp[0])
-                self.labels.append(label)
+        entries = [line.split(' ') for line in read_split_list(ann_dir)]
+        # Look up each distinct class name once and map all entries through the table
+        cls_names, cls_inverse = np.unique([e[1] for e in entries], return_inverse=True)
+        cls_lut = np.array([self.class_indices.get(c, -1) for c in cls_names], dtype=np.int64)
+        self.data += [e[0] for e in entries]
+        self.labels = np.concatenate((self.labels, cls_lut[cls_inverse])).astype(np.int64)
 
 
 @register_dataset_obj('MOZ_S1_LT')
 class MOZ_S1_LT(MOZ):
 
     name = 'MOZ_S1_LT'
-
-    def __init__(self, rootdir, class_indices, dset='train', transform=None):
-        super(MOZ_S1_LT, self).__init__(rootdir=rootdir, class_indices=class_indices, dset=dset,
-                                        transform=transform)
-        ann_dir = os.path.join(self.ann_root, '{}_mix_season_1_lt.txt'.format(self.dset))
-        self.load_data(ann_dir)
+    ann_template = '{}_mix_season_1_lt.txt'
 
 
 @register_dataset_obj('MOZ_S2_LT_FULL')
 class MOZ_S2_LT_FULL(MOZ):
 
     name = 'MOZ_S2_LT_FULL'
-
-    def __init__(self, rootdir, class_indices, dset='train', transform=None):
-        super(MOZ_S2_LT_FULL, self).__init__(rootdir=rootdir, class_indices=class_indices, dset=dset,
-                                             transform=transform)
-        ann_dir = os.path.join(self.ann_root, '{}_mix_season_2_lt.txt'.format(self.dset))
-        self.load_data(ann_dir)
+    ann_template = '{}_mix_season_2_lt.txt'
 
 
 @register_dataset_obj('MOZ_UNKNOWN')
 class MOZ_MIX_OOD(MOZ):
 
     name = 'MOZ_UNKNOWN'
+    ann_template = '{}_mix_ood.txt'
 
     def __init__(self, rootdir, class_indices, dset='train', transform=None):
         super(MOZ_MIX_OOD, self).__init__(rootdir=rootdir, class_indices=class_indices, dset=dset,
                                           transform=transform)
-        ann_dir = os.path.join(self.ann_root, '{}_mix_ood.txt'.format(dset))
-        self.load_data(ann_dir)
         self.id_out = True if dset == 'val' else False
 
     def __getitem__(self, index):
@@ -74,8 +73,7 @@ class MOZ_MIX_OOD(MOZ):
         if not file_dir.endswith('.JPG'):
             file_dir += '.jpg'
 
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        sample = pil_loader(file_dir)
 
         if self.transform is not None:
             sample = self.transform(sample)
@@ -99,10 +97,7 @@ class MOZ_S3_ALL(Dataset):
         self.load_data(ann_dir)
 
     def load_data(self, ann_dir):
-        with open(ann_dir, 'r') as f:
-            for line in f:
-                line_sp = line.replace('\n', '')
-                self.data.append(line_sp)
+        self.data.extend(read_split_list(ann_dir))
 
     def __len__(self):
         return len(self.data)
@@ -110,8 +105,8 @@ class MOZ_S3_ALL(Dataset):
     def __getitem__(self, index):
         file_id = self.data[index]
         file_dir = os.path.join(self.img_root, file_id)
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        # Deployment images are only evaluated at 256 px, so decode them at reduced scale
+        sample = pil_loader(file_dir, draft_size=(256, 256))
         if self.transform is not None:
             sample = self.transform(sample)
         return sample, file_id
@@ -129,10 +124,7 @@ class MOZ_INV(Dataset):
         self.load_data(ann_dir)
 
     def load_data(self, ann_dir):
-        with open(ann_dir, 'r') as f:
-            for line in f:
-                line_sp = line.replace('\n', '')
-                self.data.append(line_sp)
+        self.data.extend(read_split_list(ann_dir))
 
     def __len__(self):
         return len(self.data)
@@ -140,8 +132,8 @@ class MOZ_INV(Dataset):
     def __getitem__(self, index):
         file_id = self.data[index]
         file_dir = os.path.join(self.img_root, file_id)
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        # Deployment images are only evaluated at 256 px, so decode them at reduced scale
+        sample = pil_loader(file_dir, draft_size=(256, 256))
         if self.transform is not None:
             sample = self.transform(sample)
         return sample, file_id
@@ -151,6 +143,7 @@ class MOZ_INV(Dataset):
 class MOZ_S2_LT_GTPS(MOZ):
 
     name = 'MOZ_S2_LT_GTPS'
+    ann_template = '{}_mix_season_2_lt.txt'
 
     def __init__(self, rootdir, class_indices, dset='train', transform=None,
                  conf_preds=None, GTPS_mode=None):
@@ -160,9 +153,6 @@ class MOZ_S2_LT_GTPS(MOZ):
 
         self.conf_preds = conf_preds
 
-        ann_dir = os.path.join(self.ann_root, '{}_mix_season_2_lt.txt'.format(self.dset))
-        self.load_data(ann_dir)
-
         # Count classes before messing up with labels
         _, self.class_counts = self.class_counts_cal()
         self.class_counts_ann = self.class_counts_cal_ann()
@@ -181,37 +171,31 @@ class MOZ_S2_LT_GTPS(MOZ):
             print('Confidence prediction is NONE.\n')
             
     def class_counts_cal_ann(self):
-        unique_labels = np.unique(self.labels)
-        unique_ann, unique_ann_counts = np.unique(np.array(self.labels)[np.array(self.conf_preds) == 0],
-                                                  return_counts=True)
-        temp_dic = {l: c for l, c in zip(unique_ann, unique_ann_counts)}
-        ann_counts = np.array([0 for _ in range(len(unique_labels))])
-        for l in unique_labels:
-            if l in temp_dic:
-                ann_counts[l] = temp_dic[l]
+        labels = np.asarray(self.labels)
+        ann_mask = np.asarray(self.conf_preds) == 0
+        unique_ann, unique_ann_counts = np.unique(labels[ann_mask], return_counts=True)
+        ann_counts = np.zeros(len(np.unique(labels)), dtype=int)
+        ann_counts[unique_ann] = unique_ann_counts
         return ann_counts
 
     def pick_unconf(self):
         print('** PICKING GROUND TRUTHED DATA **')
-        data = np.array(self.data)
-        labels = np.array(self.labels)
-        conf_preds = np.array(self.conf_preds)
-        self.data = list(data[conf_preds == 0])
-        self.labels = list(labels[conf_preds == 0])
+        mask = np.asarray(self.conf_preds) == 0
+        self.data = [self.data[i] for i in np.flatnonzero(mask)]
+        self.labels = np.asarray(self.labels)[mask]
 
     def pick_conf(self):
         print('** PICKING PSEUDO LABLED DATA **')
-        data = np.array(self.data)
-        labels = np.array(self.labels)
-        conf_preds = np.array(self.conf_preds)
-        self.data = list(data[conf_preds == 1])
-        self.labels = list(labels[conf_preds == 1])
+        mask = np.asarray(self.conf_preds) == 1
+        self.data = [self.data[i] for i in np.flatnonzero(mask)]
+        self.labels = np.asarray(self.labels)[mask]
 
 
 @register_dataset_obj('MOZ_S2_LT_GTPS_LABEL')
 class MOZ_S2_LT_GTPS_LABEL(MOZ):
 
     name = 'MOZ_S2_LT_GTPS_LABEL'
+    ann_template = '{}_mix_season_2_lt.txt'
 
     def __init__(self, rootdir, class_indices, dset='train', transform=None,
                  conf_preds=None, pseudo_labels_hard=None, pseudo_labels_soft=None,
@@ -220,12 +204,11 @@ class MOZ_S2_LT_GTPS_LABEL(MOZ):
         super(MOZ_S2_LT_GTPS_LABEL, self).__init__(rootdir=rootdir, class_indices=class_indices, dset=dset, 
                                                    transform=transform)
 
-        ann_dir = os.path.join(self.ann_root, '{}_mix_season_2_lt.txt'.format(self.dset))
-        self.load_data(ann_dir)
-
         self.conf_preds = conf_preds
         self.pseudo_labels_hard = pseudo_labels_hard
-        self.pseudo_labels_soft = pseudo_labels_soft
+        # Soft labels are kept as one float32 array so samples can be served without conversion
+        self.pseudo_labels_soft = (np.array(pseudo_labels_soft, dtype=np.float32)
+                                   if pseudo_labels_soft is not None else None)
         self.blur = blur
 
         # Count classes before messing up with labels
@@ -255,75 +238,66 @@ class MOZ_S2_LT_GTPS_LABEL(MOZ):
         self.id_out = True if dset == 'val' else False
             
     def class_counts_cal_ann(self):
-        unique_labels = np.unique(self.labels)
-        unique_ann, unique_ann_counts = np.unique(np.array(self.labels)[np.array(self.conf_preds) == 0],
-                                                  return_counts=True)
-        temp_dic = {l: c for l, c in zip(unique_ann, unique_ann_counts)}
-        ann_counts = np.array([0 for _ in range(len(unique_labels))])
-        for l in unique_labels:
-            if l in temp_dic:
-                ann_counts[l] = temp_dic[l]
+        labels = np.asarray(self.labels)
+        ann_mask = np.asarray(self.conf_preds) == 0
+        unique_ann, unique_ann_counts = np.unique(labels[ann_mask], return_counts=True)
+        ann_counts = np.zeros(len(np.unique(labels)), dtype=int)
+        ann_counts[unique_ann] = unique_ann_counts
         return ann_counts
 
     def pick_unconf(self):
         print('** PICKING GROUND TRUTHED DATA **')
-        data = np.array(self.data)
-        labels = np.array(self.labels)
-        conf_preds = np.array(self.conf_preds)
-        self.data = list(data[conf_preds == 0])
-        self.labels = list(labels[conf_preds == 0])
+        mask = np.asarray(self.conf_preds) == 0
+        self.data = [self.data[i] for i in np.flatnonzero(mask)]
+        self.labels = np.asarray(self.labels)[mask]
         if self.pseudo_labels_soft is not None:
             print('** SOFT LABELS AS WELL **')
-            soft = np.array(self.pseudo_labels_soft)
-            self.pseudo_labels_soft = [list(l) for l in soft[conf_preds == 0]]
+            self.pseudo_labels_soft = self.pseudo_labels_soft[mask]
 
     def pick_conf(self):
         print('** PICKING PSEUDO LABLED DATA **')
-        data = np.array(self.data)
-        labels = np.array(self.labels)
-        conf_preds = np.array(self.conf_preds)
-        self.data = list(data[conf_preds == 1])
-        self.labels = list(labels[conf_preds == 1])
+        mask = np.asarray(self.conf_preds) == 1
+        self.data = [self.data[i] for i in np.flatnonzero(mask)]
+        self.labels = np.asarray(self.labels)[mask]
         if self.pseudo_labels_soft is not None:
             print('** SOFT LABELS AS WELL **')
-            soft = np.array(self.pseudo_labels_soft)
-            self.pseudo_labels_soft = [list(l) for l in soft[conf_preds == 1]]
+            self.pseudo_labels_soft = self.pseudo_labels_soft[mask]
 
     def pseudo_label_accuracy(self):
         pseudo_labels_hard = np.array(self.pseudo_labels_hard)
         labels = np.array(self.labels)
         print('** CHECKING PSEUDO LABEL ACCURACY **')
-        conf_pseudo_labels_hard = pseudo_labels_hard[pseudo_labels_hard != -1]
-        conf_labels = labels[pseudo_labels_hard != -1]
+        conf_mask = pseudo_labels_hard != -1
+        conf_pseudo_labels_hard = pseudo_labels_hard[conf_mask]
+        conf_labels = labels[conf_mask]
         acc = ((conf_pseudo_labels_hard == conf_labels).sum() / len(conf_labels)).mean()
         print('PSEUDO LABEL ACCURACY: {:3f}'.format(acc * 100))
 
     def pseudo_label_infusion(self):
         print('** INFUSING PSEUDO LABELS **')
-        conf_preds = np.array(self.conf_preds)
-        pseudo_labels_hard = np.array(self.pseudo_labels_hard)
+        conf_mask = np.asarray(self.conf_preds) == 1
+        pseudo_labels_hard = np.asarray(self.pseudo_labels_hard)
         labels = np.array(self.labels)
         self.pseudo_label_accuracy()
-        labels[conf_preds == 1] = pseudo_labels_hard[conf_preds == 1]
-        self.labels = list(labels)
+        labels[conf_mask] = pseudo_labels_hard[conf_mask]
+        self.labels = labels
 
     def __getitem__(self, index):
         file_id = self.data[index]
         label = self.labels[index]
         file_dir = os.path.join(self.img_root, file_id)
 
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
-            if self.blur:
-                blur_r = random.randint(0, 12) / 10
-                sample = sample.filter(ImageFilter.GaussianBlur(radius=blur_r))
+        sample = pil_loader(file_dir)
+        if self.blur:
+            blur_r = random.randint(0, 12) / 10
+            sample = sample.filter(ImageFilter.GaussianBlur(radius=blur_r))
 
         if self.transform is not None:
             sample = self.transform(sample)
 
         if self.pseudo_labels_soft is not None:
             soft_label = self.pseudo_labels_soft[index]
-            return sample, label, torch.tensor(soft_label)
+            return sample, label, torch.from_numpy(soft_label)
         else:
             if self.id_out:
                 return sample, label, file_id
@@ -359,8 +333,7 @@ class DEMO(Dataset):
         file_id = self.data[index]
         label = self.labels[index]
         file_dir = os.path.join(self.img_root, file_id)
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        sample = pil_loader(file_dir)
         if self.transform is not None:
             sample = self.transform(sample)
         return sample, file_id, label
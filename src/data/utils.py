@@ -2,14 +2,28 @@ import os
 import numpy as np
 from PIL import Image
 
+import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 
 from src.data.class_aware_sampler import ClassAwareSampler
 from src.data.randaugment import RandAugment
 
+def pil_loader(path, draft_size=None):
+    # draft lets the JPEG decoder downscale by DCT scaling for images that are resized anyway
+    with open(path, 'rb') as f:
+        sample = Image.open(f)
+        if draft_size is not None:
+            sample.draft('RGB', draft_size)
+        if sample.mode == 'RGB':
+            # convert would only make a full copy of the decoded pixels
+            sample.load()
+            return sample
+        return sample.convert('RGB')
+
+
 class TransformFix(object):
-    def __init__(self, mean, std, s_only=False):
+    def __init__(self, s_only=False):
         self.s_only = s_only
         self.weak = transforms.Compose([
             transforms.RandomCrop(224),
@@ -20,21 +34,20 @@ class TransformFix(object):
             transforms.RandomHorizontalFlip(),
             RandAugment(n=2, m=10)
         ])
-        self.normalize = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std)])
+        self.to_tensor = transforms.PILToTensor()
 
     def __call__(self, x):
         weak = self.weak(x)
         strong = self.strong(x)
         if self.s_only:
-            return self.normalize(strong)
+            return self.to_tensor(strong)
         else:
-            return self.normalize(weak), self.normalize(strong)
-        # return self.normalize(strong)
+            return self.to_tensor(weak), self.to_tensor(strong)
+        # return self.to_tensor(strong)
 
 
-# Standard data transform with resize and typical augmentation
+# Standard data transform with resize and typical augmentation.
+# Samples stay uint8 and are normalized on the GPU by PrefetchLoader.
 data_transforms = {
     'train_strong': transforms.Compose([
         transforms.RandomGrayscale(p=0.1),
@@ -42,28 +55,69 @@ data_transforms = {
         transforms.RandomHorizontalFlip(),
         transforms.RandomRotation(45, fill=(123, 116, 103)),
         transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0.1),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        transforms.PILToTensor()
     ]),
     'MOZ': transforms.Compose([
         # transforms.RandomResizedCrop(224, scale=(0.1, 1.0), ratio=(3. / 4., 4. / 3.)),
         transforms.RandomCrop(224),
         transforms.RandomHorizontalFlip(),
         transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4, hue=0),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        transforms.PILToTensor()
     ]),
-    'MOZ_Unlabeled': TransformFix([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-    'MOZ_Pseudolabeled': TransformFix([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], s_only=True),
+    'MOZ_Unlabeled': TransformFix(),
+    'MOZ_Pseudolabeled': TransformFix(s_only=True),
     'eval': transforms.Compose([
         transforms.Resize(256),
         transforms.CenterCrop(224),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        transforms.PILToTensor()
     ])
 }
 
 
+class PrefetchLoader(object):
+
+    """
+    Wraps a loader of uint8 image batches. The next batch is copied to the GPU, normalized and
+    made channels_last on a side stream while the current one is being consumed.
+    """
+
+    def __init__(self, loader, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.loader = loader
+        self.mean = torch.tensor([m * 255 for m in mean], device='cuda').view(1, 3, 1, 1)
+        self.std = torch.tensor([s * 255 for s in std], device='cuda').view(1, 3, 1, 1)
+
+    def normalize(self, data):
+        data = data.cuda(non_blocking=True)
+        data = data.float().sub_(self.mean).div_(self.std)
+        return data.contiguous(memory_format=torch.channels_last)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                # Weak/strong transform pairs come as a list of image batches
+                if isinstance(next_batch[0], (list, tuple)):
+                    data = [self.normalize(d) for d in next_batch[0]]
+                else:
+                    data = self.normalize(next_batch[0])
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(stream)
+            for d in (data if isinstance(data, list) else [data]):
+                d.record_stream(torch.cuda.current_stream())
+            batch = [data] + list(next_batch[1:])
+        if batch is not None:
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+
 dataset_obj = {}
 def register_dataset_obj(name):
 
@@ -89,34 +143,57 @@ def get_dataset(name, rootdir, class_indices, dset, transform, **add_args):
                              transform=data_transforms[transform], **add_args)
 
 
-def load_dataset(name, class_indices, dset, transform, batch_size=64, rootdir='',
-                 shuffle=True, num_workers=1, cas_sampler=False, **add_args):
+def get_loader(dataset, batch_size=64, shuffle=True, num_workers=1, cas_sampler=False, pin_memory=True,
+               persistent_workers=False):
 
     """
-    Dataset loader
+    Loader getter for an existing dataset
     """
 
-    if dset != 'train':
-        shuffle = False
-
     print('Shuffle is {}.'.format(shuffle))
 
-    dataset = get_dataset(name, rootdir, class_indices, dset, transform, **add_args)
-
     if len(dataset) == 0:
         return None
 
+    # More workers than cores only adds contention
+    num_workers = min(num_workers, os.cpu_count() or 1)
+
+    # Loaders iterated every epoch keep their workers alive instead of re-forking them for every pass,
+    # and each worker keeps a few batches queued ahead of the GPU.
+    # Older torch rejects these arguments without workers, so only pass them when there are some.
+    worker_args = {}
+    if num_workers > 0:
+        worker_args = {'persistent_workers': persistent_workers, 'prefetch_factor': 4}
+
     if cas_sampler:
         print("** USING CAS SAMPLER!! **")
         # TODO, sampler numbers
         sampler = ClassAwareSampler(dataset.labels, 3)
         loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                            num_workers=num_workers, pin_memory=True,
-                            sampler=sampler)
+                            num_workers=num_workers, pin_memory=pin_memory,
+                            sampler=sampler, **worker_args)
     else:
-        loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, pin_memory=True)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                            pin_memory=pin_memory, **worker_args)
 
-    return loader
+    return PrefetchLoader(loader)
+
+
+def load_dataset(name, class_indices, dset, transform, batch_size=64, rootdir='',
+                 shuffle=True, num_workers=1, cas_sampler=False, pin_memory=True, persistent_workers=False,
+                 **add_args):
+
+    """
+    Dataset loader
+    """
+
+    if dset != 'train':
+        shuffle = False
+
+    dataset = get_dataset(name, rootdir, class_indices, dset, transform, **add_args)
+
+    return get_loader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      cas_sampler=cas_sampler, pin_memory=pin_memory, persistent_workers=persistent_workers)
 
 
 class BaseDataset(Dataset):
@@ -130,12 +207,24 @@ class BaseDataset(Dataset):
         self.data = []
         self.labels = []
 
+    @property
+    def labels(self):
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        # Reassigning labels invalidates the cached class counts
+        self._labels = labels
+        self._class_counts = None
+
     def load_data(self, ann_dir):
         pass
 
     def class_counts_cal(self):
-        unique_labels, unique_counts = np.unique(self.labels, return_counts=True)
-        return unique_labels, unique_counts
+        # Counts are computed once per label assignment and reused by every evaluation pass
+        if self._class_counts is None:
+            self._class_counts = np.unique(self.labels, return_counts=True)
+        return self._class_counts
 
     def __len__(self):
         return len(self.labels)
@@ -147,8 +236,7 @@ class BaseDataset(Dataset):
         if not file_dir.endswith('.JPG'):
             file_dir += '.jpg'
 
-        with open(file_dir, 'rb') as f:
-            sample = Image.open(f).convert('RGB')
+        sample = pil_loader(file_dir)
 
         if self.transform is not None:
             sample = self.transform(sample)
@@ -1,5 +1,4 @@
 import os
-import copy
 import math
 from collections import OrderedDict
 import torch
@@ -97,7 +96,11 @@ class SoftOLTRResNetClassifier(BaseModule):
         if 'http' in init_path:
             init_weights = load_state_dict_from_url(init_path, progress=True)
         else:
-            init_weights = torch.load(init_path)
+            try:
+                init_weights = torch.load(init_path, map_location='cpu', mmap=True)
+            except (TypeError, RuntimeError):
+                # mmap needs torch >= 2.1 and a zip-format checkpoint
+                init_weights = torch.load(init_path, map_location='cpu')
 
         if feat_only:
             # init_weights = OrderedDict({k.replace('feature.', ''): init_weights[k] for k in init_weights})
@@ -132,7 +135,8 @@ class SoftOLTRResNetClassifier(BaseModule):
         torch.save(self.best_weights, out_path)
 
     def update_best(self):
-        self.best_weights = copy.deepcopy(self.state_dict())
+        # Keep the snapshot in host memory so it does not hold a second copy of the weights on the GPU
+        self.best_weights = {k: v.detach().to('cpu', copy=True) for k, v in self.state_dict().items()}
 
 
 class CosNorm_Classifier(nn.Module):
@@ -150,7 +154,7 @@ class CosNorm_Classifier(nn.Module):
         self.weight.data.uniform_(-stdv, stdv)
 
     def forward(self, input, *args):
-        norm_x = torch.norm(input.clone(), 2, 1, keepdim=True)
+        norm_x = torch.norm(input, 2, 1, keepdim=True)
         ex = (norm_x / (1 + norm_x)) * (input / norm_x)
         ew = self.weight / torch.norm(self.weight, 2, 1, keepdim=True)
         return torch.mm(self.scale * ex, ew.t())
@@ -161,6 +165,8 @@ class DiscCentroidsLoss(nn.Module):
         super(DiscCentroidsLoss, self).__init__()
         self.num_classes = num_classes
         self.centroids = nn.Parameter(torch.randn(num_classes, feat_dim))
+        # Class indices for the repelling mask, kept on the module's device
+        self.register_buffer('classes', torch.arange(num_classes).long(), persistent=False)
         self.disccentroidslossfunc = DiscCentroidsLossFunc.apply
         self.feat_dim = feat_dim
         self.size_average = size_average
@@ -182,20 +188,19 @@ class DiscCentroidsLoss(nn.Module):
 
         batch_size_tensor = feat.new_empty(1).fill_(batch_size if self.size_average else 1)
 
-        loss_attract = self.disccentroidslossfunc(feat.clone(), label, self.centroids.clone(), batch_size_tensor).squeeze()
+        loss_attract = self.disccentroidslossfunc(feat, label, self.centroids, batch_size_tensor).squeeze()
 
         ############################
         # calculate repelling loss #
         #############################
 
-        distmat = torch.pow(feat.clone(), 2).sum(dim=1, keepdim=True).expand(batch_size, self.num_classes) + \
-                  torch.pow(self.centroids.clone(), 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
+        distmat = torch.pow(feat, 2).sum(dim=1, keepdim=True).expand(batch_size, self.num_classes) + \
+                  torch.pow(self.centroids, 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
 
-        distmat.addmm_(1, -2, feat.clone(), self.centroids.clone().t())
+        distmat.addmm_(1, -2, feat, self.centroids.t())
 
-        classes = torch.arange(self.num_classes).long().cuda()
         labels_expand = label.unsqueeze(1).expand(batch_size, self.num_classes)
-        mask = labels_expand.eq(classes.expand(batch_size, self.num_classes))
+        mask = labels_expand.eq(self.classes.expand(batch_size, self.num_classes))
 
         distmat_neg = distmat
         distmat_neg[mask] = 0.0
@@ -1,5 +1,4 @@
 import os
-import copy
 from collections import OrderedDict
 import torch
 import torch.nn as nn
@@ -78,7 +77,11 @@ class PlainResNetClassifier(BaseModule):
         if 'http' in init_path:
             init_weights = load_state_dict_from_url(init_path, progress=True)
         else:
-            init_weights = torch.load(init_path)
+            try:
+                init_weights = torch.load(init_path, map_location='cpu', mmap=True)
+            except (TypeError, RuntimeError):
+                # mmap needs torch >= 2.1 and a zip-format checkpoint
+                init_weights = torch.load(init_path, map_location='cpu')
 
         if feat_only:
             init_weights = OrderedDict({k.replace('module.', '').replace('feature.', ''): init_weights[k] for k in init_weights})
@@ -101,7 +104,8 @@ class PlainResNetClassifier(BaseModule):
         torch.save(self.state_dict, out_path.replace('.pth', '_final.pth'))
 
     def update_best(self):
-        self.best_weights = copy.deepcopy(self.state_dict())
+        # Keep the snapshot in host memory so it does not hold a second copy of the weights on the GPU
+        self.best_weights = {k: v.detach().to('cpu', copy=True) for k, v in self.state_dict().items()}
 
 
 class NormedLinear(nn.Module):
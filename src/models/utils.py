@@ -25,6 +25,8 @@ def get_model(name, **args):
     net = models[name](**args)
     if torch.cuda.is_available():
         net = net.cuda()
+    # NHWC layout lets cudnn pick tensor core convolution kernels
+    net = net.to(memory_format=torch.channels_last)
     return net
 
 